@@ -1,14 +1,15 @@
-import os, sys, json, glob
+import os, sys, json, time
 
-import boto3, requests, sqlalchemy, jinja2
-from requests_http_signature import HTTPSignatureAuth
+import requests
 from chalice import Chalice, Response
+from werkzeug.http import parse_etags
 from dcplib import aws
 
 import dcpquery
 from dcpquery import api, ui, config
-from dcpquery.api.query_jobs import process_async_query, set_job_status
-from dcpquery.dss_subscription_event_handling import process_bundle_event
+
+# Modules needed by only some of the handlers defined here are imported by those handlers, so that each Lambda function
+# only loads what it uses (see scripts/benchmark_cold_start.py)
 
 swagger_spec_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), f'{os.environ["APP_NAME"]}-api.yml')
 app = api.DCPQueryServer(app_name=os.environ["APP_NAME"], swagger_spec_path=swagger_spec_path)
@@ -18,11 +19,12 @@ config.configure_logging()
 
 @app.route("/")
 def root():
-    ui_assets_dir = os.path.join(os.path.abspath(os.path.dirname(dcpquery.__file__)), "ui")
-    queries = [open(f).read() for f in glob.glob(os.path.join(ui_assets_dir, "queries/*"))]
-    with open(os.path.join(ui_assets_dir, "index.html")) as fh:
-        body = jinja2.Template(fh.read()).render(env=os.environ, queries=queries)
-    return Response(status_code=requests.codes.ok, headers={"Content-Type": "text/html"}, body=body)
+    body, etag = ui.get_page()
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"public, max-age={config.ui_max_age_seconds}",
+               "Vary": "Accept-Encoding"}
+    if parse_etags(app.current_request.headers.get("If-None-Match")).contains(etag):
+        return Response(status_code=requests.codes.not_modified, headers=headers, body="")
+    return Response(status_code=requests.codes.ok, headers=dict(headers, **{"Content-Type": "text/html"}), body=body)
 
 
 @app.route("/internal/health")
@@ -39,6 +41,7 @@ def serve_version():
 
 @app.route("/bundles/event", methods=["POST"])
 def receive_bundle_event():
+    from requests_http_signature import HTTPSignatureAuth
     app.log.info("Received bundle event: %s", app.current_request.json_body)
     try:
         # The hostname component is ignored in signature calculation
@@ -56,12 +59,40 @@ def receive_bundle_event():
 
 @app.on_sqs_message(queue=config.bundle_events_queue_name)
 def bundle_event_handler(event):
+    from dcpquery.dss_subscription_event_handling import process_bundle_event
     for record in event:
         app.log.info(f"Processing bundle event: {record.body}")
         process_bundle_event(json.loads(record.body))
 
 
-@app.on_sqs_message(queue=config.async_queries_queue_name)
+def get_deadline(event):
+    """
+    Returns the time.time() at which the Lambda function handling an event times out, if known.
+    """
+    if event.context is None:
+        return None
+    return time.time() + event.context.get_remaining_time_in_millis() / 1000
+
+
+@app.on_sqs_message(queue=config.get_async_queries_queue_name("interactive"),
+                    batch_size=config.async_query_lanes["interactive"]["concurrency"])
 def async_query_handler(event):
-    for record in event:
-        process_async_query(record.to_dict())
+    from dcpquery.api.query_jobs import process_async_queries
+    process_async_queries([record.to_dict() for record in event], lane="interactive",
+                          deadline=get_deadline(event))
+
+
+@app.on_sqs_message(queue=config.get_async_queries_queue_name("bulk"),
+                    batch_size=config.async_query_lanes["bulk"]["concurrency"])
+def bulk_async_query_handler(event):
+    from dcpquery.api.query_jobs import process_async_queries
+    process_async_queries([record.to_dict() for record in event], lane="bulk",
+                          deadline=get_deadline(event))
+
+
+@app.on_sqs_message(queue=config.get_async_queries_queue_name("internal"),
+                    batch_size=config.async_query_lanes["internal"]["concurrency"])
+def internal_async_query_handler(event):
+    from dcpquery.api.query_jobs import process_async_queries
+    process_async_queries([record.to_dict() for record in event], lane="internal",
+                          deadline=get_deadline(event))
@@ -2,7 +2,7 @@ import os, sys, json, logging, getpass, typing, threading
 
 from dcplib.aws_secret import AwsSecret
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +16,17 @@ class DCPQueryConfig:
     async_queries_queue_name = os.environ["ASYNC_QUERIES_QUEUE_NAME"]
     s3_bucket_name = os.environ["SERVICE_S3_BUCKET"]
     webhook_secret_name = os.environ["WEBHOOK_SECRET_NAME"]
+    job_callback_secret_name = f"{app_name}/{stage}/job-callback-auth-config"
 
     debug = False
     echo = False
     silence_debug_loggers = ["botocore"]
 
     API_GATEWAY_MAX_RESULT_SIZE = 8 * 1024 * 1024
-    S3_SINGLE_UPLOAD_MAX_SIZE = 64 * 1024 * 1024
+    # Async query results are uploaded to S3 in parts of this size as they are fetched
+    s3_multipart_upload_part_size = 16 * 1024 * 1024
+    # If set, async query results are written to this directory instead of S3 (for local testing)
+    local_job_result_dir = None  # type: typing.Optional[str]
 
     try:
         import chalice.local
@@ -30,11 +34,115 @@ class DCPQueryConfig:
     except ImportError:
         local_mode = False
 
+    # Dispatch API requests straight to the operation functions instead of through Connexion (see api/fast_path.py)
+    api_fast_path = True
+    # Start the API from the compiled spec built by `make package`, if present (see api/spec.py)
+    api_compiled_spec = True
+    # Browsers and CDNs may reuse the UI page for this long before revalidating it with its ETag
+    ui_max_age_seconds = 300
+    # The statement timeout is applied to each database transaction with SET LOCAL, so it can be changed (see
+    # reset_db_timeout_seconds) without reconnecting
     db_statement_timeout_seconds = 20
+    # Each container keeps one connection pool for its lifetime, so connections stay open across invocations. Pooled
+    # connections are checked before use, since a frozen container may find them closed by the server when it thaws.
+    db_pool_size = 5
+    db_pool_max_overflow = 5
+    db_pool_recycle_seconds = 1800
+    # Execute single-statement queries with server-side cursors, fetching this many rows per round trip
+    db_stream_results = True
+    db_fetch_size = 100
+    async_query_fetch_size = 1000
+    # Async query results are stored in chunks of up to this many rows, which clients can download separately
+    job_result_chunk_rows = 1000000  # type: typing.Optional[int]
+    # Async query jobs run in lanes, each with its own FIFO queue, worker concurrency and statement timeout. Jobs
+    # estimated to cost more than async_query_bulk_min_estimated_cost go to the bulk lane, and jobs submitted by the
+    # service itself (e.g. by the ETL) to the internal lane. Each caller's jobs are spread over
+    # async_query_message_group_buckets message groups, so a caller with a backlog of jobs cannot hold up the jobs of
+    # other callers in the same lane. A worker receives batches of up to "concurrency" jobs and runs them at once.
+    async_query_lanes = {
+        "interactive": {"concurrency": 4, "timeout_seconds": 300},
+        "bulk": {"concurrency": 2, "timeout_seconds": 880},
+        "internal": {"concurrency": 2, "timeout_seconds": 880}
+    }
+    async_query_bulk_min_estimated_cost = 10 ** 9
+    async_query_message_group_buckets = 4
+    # Jobs that fail with an unexpected error are retried until their message has been received this many times (the
+    # maxReceiveCount of the async query queues' redrive policy, in terraform/api.tf)
+    async_query_max_receives = 5
+    # Queries whose planner estimates exceed these limits are sent straight to the async query path
+    sync_query_max_estimated_cost = 10 ** 7
+    sync_query_max_estimated_rows = 10 ** 6
+    # For clients that accept a compressed response, API_GATEWAY_MAX_RESULT_SIZE applies to the compressed sync query
+    # result, which is compressed while it is encoded. The uncompressed result is still limited to this size, which
+    # must leave room in the API Lambda function's memory (lambda_memory_size in .chalice/config.in.json) for the
+    # result, its compressed form, their cache entries and the encoded response at once.
+    sync_query_max_uncompressed_result_size = 32 * 1024 * 1024
+    # Hand off the open cursor of a sync query that overflows API_GATEWAY_MAX_RESULT_SIZE to the job result store. The
+    # cursor keeps its db_statement_timeout_seconds time limit; a hand-off that exceeds it is abandoned and the query is
+    # executed again by an async query job.
+    sync_query_handoff = True
+    # Sync query results are cached in-process up to this total size, and optionally in a shared store given as a
+    # directory path or an s3://bucket/prefix/ URL
+    query_result_cache_size = 64 * 1024 * 1024
+    query_result_cache_url = None  # type: typing.Optional[str]
+    # The data generation that query results and estimates are cached under is read from the database at most this
+    # often per container, so a cached result may still be served for this long after the ETL changes the data
+    data_generation_max_age_seconds = 5
+    # Identical async queries share a job while it is new or running, and completed jobs are reused for identical
+    # queries within the retention period, if the data has not changed since. (Sync queries are not coalesced: each
+    # Lambda container serves one request at a time, and the result cache covers repeated queries.)
+    coalesce_queries = True
+    query_job_result_retention_seconds = 7 * 24 * 60 * 60
+    # Job status is stored in the service S3 bucket, unless a different job store URL is given (see api/job_store.py).
+    # Presigned job result URLs are reused until they are this close to expiring.
+    job_store_url = None  # type: typing.Optional[str]
+    job_result_url_expiration_seconds = 7 * 24 * 60 * 60
+    job_result_url_refresh_seconds = 24 * 60 * 60
+    # Running query jobs publish their progress and check whether they have been cancelled at these intervals. Clients
+    # can long-poll job status for up to query_job_max_wait_seconds, polled at intervals that back off from
+    # query_job_poll_interval_seconds to query_job_max_poll_interval_seconds, and are asked to retry after an interval
+    # estimated from the job's progress.
+    query_job_progress_interval_seconds = 5
+    query_job_cancel_check_interval_seconds = 2
+    query_job_poll_interval_seconds = 1
+    query_job_max_poll_interval_seconds = 5
+    query_job_max_wait_seconds = 20
+    query_job_min_retry_after_seconds = 1
+    query_job_max_retry_after_seconds = 60
+    # API responses are compressed if the client accepts it and the body is at least response_compression_min_size
+    # bytes. Each tier lists the content encodings and levels to use, in order of preference, for bodies up to its
+    # max_size; larger bodies use cheaper levels, so that compression does not dominate request time. Compressed
+    # bodies of cacheable responses are kept in an in-process LRU of up to response_compression_cache_size bytes.
+    response_compression_min_size = 1024
+    response_compression_tiers = [
+        {"max_size": 1024 * 1024, "codecs": [("br", 5), ("gzip", 6)]},
+        {"max_size": 4 * 1024 * 1024, "codecs": [("br", 3), ("gzip", 3)]},
+        {"max_size": None, "codecs": [("br", 1), ("gzip", 1)]}
+    ]  # type: typing.List[typing.Dict[str, typing.Any]]
+    response_compression_cache_size = 32 * 1024 * 1024
+    # Jobs submitted with a callback URL POST their final status to it, signed with the active job callback HMAC key
+    # (see job_callback_secret_name). Failed deliveries are retried up to job_callback_max_attempts times, backing off
+    # exponentially from job_callback_backoff_seconds, unless the retry would end less than
+    # job_callback_deadline_margin_seconds before the worker's Lambda function times out.
+    job_callback_max_attempts = 5
+    job_callback_backoff_seconds = 1
+    job_callback_timeout_seconds = 10
+    job_callback_deadline_margin_seconds = 10
+    # Responses are validated against the API spec for a random sample of requests, at this rate (0 to 1). Response
+    # bodies larger than response_validation_max_full_size bytes are only checked against the top level of their
+    # schema, and bodies larger than response_validation_max_size bytes (which can only be sent compressed) are not
+    # validated, since parsing them takes several times their size in memory. Validation time is published as the
+    # ResponseValidationTime metric, by route.
+    response_validation_sample_rate = 0.1
+    response_validation_max_full_size = 1024 * 1024
+    response_validation_max_size = API_GATEWAY_MAX_RESULT_SIZE
     _db = None
     _db_session_factory = None
-    _db_sessions: typing.Dict[int, typing.Any] = {}
+    _db_sessions: typing.Dict[int, typing.Tuple[typing.Optional[int], typing.Any]] = {}
+    _db_sessions_lock = threading.Lock()
     _webhook_keys = None
+    _active_webhook_key_id = None
+    _job_callback_key = None
     _db_engine_params = {
         "connect_args": {"options": ""},
         "implicit_returning": False
@@ -48,23 +156,68 @@ class DCPQueryConfig:
             self._webhook_keys = json.loads(secret.value)["hmac_keys"]
         return self._webhook_keys
 
+    @property
+    def active_webhook_key_id(self):
+        if self._active_webhook_key_id is None:
+            secret = AwsSecret(self.webhook_secret_name)
+            self._active_webhook_key_id = json.loads(secret.value)["active_hmac_key"]
+        return self._active_webhook_key_id
+
+    @property
+    def job_callback_key(self):
+        """
+        Returns the ID and value of the active HMAC key that job callbacks are signed with. These keys are kept apart
+        from the webhook keys, so that a job callback cannot be passed off as a bundle event.
+        """
+        if self._job_callback_key is None:
+            secret = json.loads(AwsSecret(self.job_callback_secret_name).value)
+            self._job_callback_key = secret["active_hmac_key"], secret["hmac_keys"][secret["active_hmac_key"]]
+        return self._job_callback_key
+
+    def get_async_queries_queue_name(self, lane):
+        return f"{self.async_queries_queue_name}-{lane}.fifo"
+
     def reset_db_timeout_seconds(self, timeout_seconds):
-        if self.db_statement_timeout_seconds != timeout_seconds:
-            self.db_statement_timeout_seconds = timeout_seconds
-            self.reset_db_session()
+        """
+        Sets the statement timeout of database transactions started from now on.
+        """
+        self.db_statement_timeout_seconds = timeout_seconds
+
+    def set_db_transaction_timeout(self, connection, timeout_seconds=None):
+        """
+        Sets the statement timeout for the rest of the transaction open on a database connection.
+        """
+        timeout_ms = int((timeout_seconds or self.db_statement_timeout_seconds) * 1000)
+        connection.execute("SET LOCAL statement_timeout = %(timeout_ms)s", dict(timeout_ms=timeout_ms))
 
     def reset_db_session(self):
+        """
+        Closes all database sessions and connections. The engine is created again when it is next used, e.g. with
+        different parameters or for a different database (see readonly_db).
+        """
+        with self._db_sessions_lock:
+            for request_id, session in self._db_sessions.values():
+                session.close()
+            self._db_sessions.clear()
+        if self._db is not None:
+            self._db.dispose()
         self._db = None
         self._db_session_factory = None
-        self._db_sessions.clear()
 
     @property
     def db(self):
         if self._db is None:
-            connect_opts = " -c statement_timeout={}s".format(self.db_statement_timeout_seconds)
-            self._db_engine_params["connect_args"]["options"] += connect_opts
-            self._db_engine_params["echo"] = self.echo
-            self._db = sqlalchemy.create_engine(self.db_url, **self._db_engine_params)
+            # Statements outside of a transaction that sets its own timeout are limited by the timeout in effect when
+            # the connection was opened
+            connect_args = dict(self._db_engine_params["connect_args"])
+            connect_args["options"] += " -c statement_timeout={}s".format(self.db_statement_timeout_seconds)
+            self._db = sqlalchemy.create_engine(self.db_url, **dict(self._db_engine_params,
+                                                                    connect_args=connect_args,
+                                                                    echo=self.echo,
+                                                                    pool_size=self.db_pool_size,
+                                                                    max_overflow=self.db_pool_max_overflow,
+                                                                    pool_recycle=self.db_pool_recycle_seconds,
+                                                                    pool_pre_ping=True))
         return self._db
 
     @property
@@ -87,13 +240,22 @@ class DCPQueryConfig:
 
     @property
     def db_session(self):
+        """
+        Returns the database session of the current thread and API request. When a thread starts serving a new request,
+        the session of its previous request is closed, returning its connection to the pool.
+        """
         if self._db_session_factory is None:
-            self._db_session_factory = scoped_session(sessionmaker(bind=self.db))
-        session_id = id(self.app.current_request) if self.app else threading.get_ident()
-        if session_id not in self._db_sessions:
-            self._db_sessions.clear()
-            self._db_sessions[session_id] = self._db_session_factory()
-        return self._db_sessions[session_id]
+            self._db_session_factory = sessionmaker(bind=self.db)
+            sqlalchemy.event.listen(self._db_session_factory, "after_begin",
+                                    lambda session, transaction, conn: self.set_db_transaction_timeout(conn))
+        request_id = id(self.app.current_request) if self.app else None
+        thread_id = threading.get_ident()
+        with self._db_sessions_lock:
+            if thread_id in self._db_sessions and self._db_sessions[thread_id][0] != request_id:
+                self._db_sessions.pop(thread_id)[1].close()
+            if thread_id not in self._db_sessions:
+                self._db_sessions[thread_id] = (request_id, self._db_session_factory())
+            return self._db_sessions[thread_id][1]
 
     def configure_logging(self):
         logging.basicConfig()
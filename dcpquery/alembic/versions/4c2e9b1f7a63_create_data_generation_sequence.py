@@ -0,0 +1,29 @@
+"""create data generation sequence
+
+Revision ID: 4c2e9b1f7a63
+Revises: 132698d15453
+Create Date: 2019-11-04 16:12:31.204519
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4c2e9b1f7a63'
+down_revision = '132698d15453'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The data generation is incremented by the ETL whenever it changes the data. Calling nextval() once here makes
+    # last_value the current generation from the start.
+    op.execute(
+        """
+        CREATE SEQUENCE data_generation;
+        SELECT nextval('data_generation');
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP SEQUENCE data_generation;")
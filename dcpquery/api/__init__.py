@@ -1,13 +1,19 @@
-import os, sys, re, json, collections, logging, datetime, uuid, gzip, traceback
+import os, sys, re, json, time, collections, logging, datetime, uuid, traceback
 from decimal import Decimal
 
-import requests, connexion, chalice, brotli
+import requests, connexion, chalice
 from sqlalchemy.engine.result import RowProxy
 from connexion.resolver import RestyResolver
 from connexion.lifecycle import ConnexionResponse
 from connexion.exceptions import ProblemException
 from werkzeug.http import parse_accept_header
 
+from .. import config
+from .compression import choose_content_encoding, compress_body
+from .fast_path import FastRouter
+from .response_validation import SampledResponseValidator
+from .spec import load_compiled_spec, get_routes, CompiledSpecFlaskApi
+
 
 class JSONEncoder(json.JSONEncoder):
     """
@@ -49,30 +55,55 @@ class ChaliceWithConnexion(chalice.Chalice):
     def __init__(self, swagger_spec_path, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.swagger_spec_path = swagger_spec_path
-        self.connexion_app = self.create_connexion_app()
-        self.trailing_slash_routes = []
-        routes = collections.defaultdict(list)
-        for rule in self.connexion_app.app.url_map.iter_rules():
-            route = re.sub(r"<(.+?)(:.+?)?>", r"{\1}", rule.rule)
-            if route.endswith("/"):
-                self.trailing_slash_routes.append(route.rstrip("/"))
-            routes[route.rstrip("/")] += rule.methods
+        self._connexion_app, self._fast_router = None, None
+        # If the spec has been compiled (see api/spec.py), the Connexion app is built when the first request arrives
+        compiled_spec = load_compiled_spec(swagger_spec_path)
+        if compiled_spec is None:
+            self.swagger_spec = None
+            routes, self.trailing_slash_routes = get_routes(self.connexion_app.app)
+        else:
+            self.swagger_spec = compiled_spec["spec"]
+            routes, self.trailing_slash_routes = compiled_spec["routes"], compiled_spec["trailing_slash_routes"]
         for route, methods in routes.items():
-            self.route(route, methods=list(set(methods) - {"OPTIONS"}), cors=True)(self.dispatch)
+            self.route(route, methods=methods, cors=True)(self.dispatch)
 
-    def render_internal_error(self, error):
+    def load_connexion_app(self):
+        if self._connexion_app is None:
+            self._connexion_app = self.create_connexion_app()
+            self._fast_router = FastRouter(self.connexion_api, json_encoder=JSONEncoder,
+                                           internal_error=self.internal_error_problem)
+
+    @property
+    def connexion_app(self):
+        self.load_connexion_app()
+        return self._connexion_app
+
+    @property
+    def fast_router(self):
+        self.load_connexion_app()
+        return self._fast_router
+
+    def internal_error_problem(self, error):
         self.log.error(traceback.format_exc())
-        return self.connexion_app.common_error_handler(ProblemException(
+        return ProblemException(
             status=requests.codes.internal_server_error,
             title=repr(error),
             detail=traceback.format_exc() if self.debug else None
-        ))
+        )
+
+    def render_internal_error(self, error):
+        return self.connexion_app.common_error_handler(self.internal_error_problem(error))
 
     def create_connexion_app(self):
         app = connexion.App(self.app_name)
+        if self.swagger_spec is not None:
+            app.api_cls = CompiledSpecFlaskApi
         app.app.json_encoder = JSONEncoder
         resolver = RestyResolver(self.app_name + '.api', collection_endpoint_name="list")
-        app.add_api(self.swagger_spec_path, resolver=resolver, validate_responses=True, arguments=os.environ)
+        self.connexion_api = app.add_api(self.swagger_spec or self.swagger_spec_path, resolver=resolver,
+                                         validate_responses=True,
+                                         validator_map={"response": SampledResponseValidator},
+                                         arguments=os.environ)
         app.add_error_handler(Exception, self.render_internal_error)
         return app
 
@@ -84,6 +115,12 @@ class ChaliceWithConnexion(chalice.Chalice):
                 path += "/"
             else:
                 return chalice.Response(status_code=requests.codes.found, headers={"Location": path + "/"}, body="")
+        if config.api_fast_path:
+            fast_route = self.fast_router.get(self.current_request.context["resourcePath"], self.current_request.method)
+            if fast_route is not None:
+                res = fast_route(self.current_request, uri_params)
+                if res is not None:
+                    return res
         req_body = self.current_request.raw_body if self.current_request._body is not None else None
         base_url = "https://{}".format(self.current_request.headers["host"])
         query_string = self.current_request.query_params or {}
@@ -97,8 +134,7 @@ class ChaliceWithConnexion(chalice.Chalice):
             flask_res = self.connexion_app.app.full_dispatch_request()
         res_headers = dict(flask_res.headers)
         res_headers.pop("Content-Length", None)
-        res_body = b"".join([c for c in flask_res.response])
-        return chalice.Response(status_code=flask_res._status_code, headers=res_headers, body=res_body)
+        return chalice.Response(status_code=flask_res._status_code, headers=res_headers, body=flask_res.response)
 
 
 class ChaliceWithRequestLogging(chalice.Chalice):
@@ -119,6 +155,11 @@ class ChaliceWithRequestLogging(chalice.Chalice):
 
 
 class ChaliceWithGzipBinaryResponses(chalice.Chalice):
+    """
+    Compresses response bodies with a content encoding accepted by the client, chosen by body size (see
+    api/compression.py), and reports the time spent compressing in a Server-Timing header.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.api.binary_types.append('*/*')
@@ -127,16 +168,33 @@ class ChaliceWithGzipBinaryResponses(chalice.Chalice):
         res = super()._get_view_function_response(view_function, function_args)
         if isinstance(res.body, dict):
             res.body = json.dumps(res.body)
-        if not isinstance(res.body, bytes):
+        if isinstance(res.body, str):
             res.body = res.body.encode()
+        # Views may return the body as a list or iterator of chunks, which are compressed as they are produced
+        chunks = [res.body] if isinstance(res.body, bytes) else res.body
+        size = sum(len(chunk) for chunk in chunks) if isinstance(chunks, list) else None
+        content_encoding, level = None, None
         if "Content-Encoding" not in res.headers:
             accept_encoding = parse_accept_header(self.current_request.headers.get("Accept-Encoding"))
-            if "br" in accept_encoding:
-                res.body = brotli.compress(res.body, mode=brotli.MODE_TEXT, quality=5)
-                res.headers["Content-Encoding"] = "br"
-            elif "gzip" in accept_encoding:
-                res.body = gzip.compress(res.body)
-                res.headers["Content-Encoding"] = "gzip"
+            content_encoding, level = choose_content_encoding(accept_encoding, size)
+        if content_encoding is None:
+            res.body = b"".join(chunks)
+            return res
+        # Only bodies that are likely to be served again are cached: those with an ETag, and query result cache hits.
+        # Query results that missed or bypassed that cache were compressed by the view, which hands them over.
+        cacheable = "ETag" in res.headers or res.headers.get("X-Cache") == "hit"
+        if "no-store" in res.headers.get("Cache-Control", ""):
+            cacheable = False
+        start_time = time.time()
+        res.body, cached = compress_body(chunks, content_encoding, level, cacheable=cacheable,
+                                         precompressed="X-Cache" in res.headers)
+        res.headers["Content-Encoding"] = content_encoding
+        duration_ms = (time.time() - start_time) * 1000
+        server_timing = 'compress;dur={:.1f};desc="{} {}"'.format(duration_ms, content_encoding,
+                                                                  "cached" if cached else level)
+        if "Server-Timing" in res.headers:
+            server_timing = res.headers["Server-Timing"] + ", " + server_timing
+        res.headers["Server-Timing"] = server_timing
         return res
 
 
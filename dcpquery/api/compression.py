@@ -0,0 +1,133 @@
+"""
+Compression of API response bodies and query results.
+
+Response bodies are compressed according to a size-aware policy (see config.response_compression_tiers): bodies too
+small to benefit are sent as they are, and the larger a body is, the cheaper the codec level used to compress it.
+Bodies are compressed one chunk at a time, as they are produced.
+"""
+import io, zlib, hashlib
+
+import brotli
+
+from .. import config
+from ..exceptions import QuerySizeError
+from .result_cache import LRUCache
+
+
+class BrotliCompressor:
+    """
+    Adapts brotli.Compressor to the compress()/flush() interface of zlib compression objects.
+    """
+
+    def __init__(self, **kwargs):
+        self._compressor = brotli.Compressor(**kwargs)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        return self._compressor.finish() if mode == zlib.Z_FINISH else self._compressor.flush()
+
+
+def get_compressor(content_encoding, level=None):
+    if content_encoding is None:
+        return None
+    elif content_encoding == "gzip":
+        return zlib.compressobj(9 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif content_encoding == "br":
+        return BrotliCompressor(mode=brotli.MODE_TEXT, quality=5 if level is None else level)
+    raise ValueError(f"Unsupported content encoding {content_encoding}")
+
+
+def choose_content_encoding(accepted_encodings, size):
+    """
+    Returns the content encoding and level to compress a response body of this size with, or (None, None) if it should
+    be sent uncompressed. A size of None (a streamed body of unknown size) is treated as larger than any tier limit.
+    """
+    if size is not None and size < config.response_compression_min_size:
+        return None, None
+    tiers = config.response_compression_tiers
+    tier = next((tier for tier in tiers if tier["max_size"] is None or (size is not None and size <= tier["max_size"])),
+                tiers[-1])
+    for content_encoding, level in tier["codecs"]:
+        if content_encoding in accepted_encodings:
+            return content_encoding, level
+    return None, None
+
+
+compressed_bodies = LRUCache(max_size=config.response_compression_cache_size)
+
+
+def cache_compressed_body(body, content_encoding, compressed_body):
+    """
+    Caches the compressed form of a response body, keyed by the hash of the uncompressed body and the content encoding.
+    This is also how a view that has already compressed its response body hands it over to compress_body.
+    """
+    compressed_bodies.max_size = config.response_compression_cache_size
+    compressed_bodies.put(f"{hashlib.sha256(body).hexdigest()}.{content_encoding}", compressed_body)
+
+
+def compress_body(chunks, content_encoding, level, cacheable=False, precompressed=False):
+    """
+    Compresses an iterable of body chunks incrementally. Returns the compressed body and a flag that is True if it was
+    found in the cache of compressed bodies. Compressed bodies of cacheable responses are cached by the hash of the
+    uncompressed body, so a response served repeatedly (e.g. from the query result cache) is compressed only once. The
+    compressed form of a precompressed response that is not cacheable is taken out of the cache, if the view put it
+    there (see cache_compressed_body), and is not cached again.
+    """
+    if cacheable or precompressed:
+        body = b"".join(chunks)
+        key = f"{hashlib.sha256(body).hexdigest()}.{content_encoding}"
+        compressed_body = compressed_bodies.get(key) if cacheable else compressed_bodies.pop(key)
+        if compressed_body is not None:
+            return compressed_body, True
+        chunks = [body]
+    compressor = get_compressor(content_encoding, level)
+    compressed_body = b"".join([compressor.compress(chunk) for chunk in chunks] + [compressor.flush()])
+    if cacheable:
+        cache_compressed_body(body, content_encoding, compressed_body)
+    return compressed_body, False
+
+
+class CompressingBuffer(io.BytesIO):
+    """
+    A BytesIO that also compresses the data written to it as it arrives, and raises QuerySizeError as soon as the
+    compressed output exceeds max_compressed_size. The uncompressed data remains available from getvalue(), and the
+    compressed data from compressed_value() once all data has been written.
+
+    The compressor may buffer some of its input, so the size limit is only exact after flush() or compressed_value().
+    """
+
+    def __init__(self, content_encoding, level=None, max_compressed_size=None):
+        super().__init__()
+        self.content_encoding = content_encoding
+        self.max_compressed_size = max_compressed_size
+        self._compressor = get_compressor(content_encoding, level)
+        self._compressed = io.BytesIO()
+
+    @property
+    def compressed_size(self):
+        return self._compressed.tell()
+
+    def _check_compressed_size(self):
+        if self.max_compressed_size is not None and self.compressed_size > self.max_compressed_size:
+            raise QuerySizeError(title="Compressed query result exceeds maximum size",
+                                 detail=str(self.max_compressed_size))
+
+    def write(self, data):
+        size = super().write(data)
+        self._compressed.write(self._compressor.compress(data))
+        self._check_compressed_size()
+        return size
+
+    def flush(self):
+        if self._compressor is not None:
+            self._compressed.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._check_compressed_size()
+
+    def compressed_value(self):
+        if self._compressor is not None:
+            self._compressed.write(self._compressor.flush())
+            self._compressor = None
+            self._check_compressed_size()
+        return self._compressed.getvalue()
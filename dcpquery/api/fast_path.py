@@ -0,0 +1,149 @@
+"""
+Direct dispatch of API requests from Chalice to the API operation functions.
+
+ChaliceWithConnexion proxies requests into the Connexion app through a Werkzeug test request context. FastRouter instead
+compiles the operations in the API spec into a table of routes at startup. Each route validates parameters and JSON
+request bodies with Connexion's own validators, builds the operation function arguments the way Connexion does, and
+calls the function directly. Requests that a route can't handle (e.g. bodies that are not JSON) fall back to Connexion.
+
+Operation functions must not depend on a Flask request context: they can read the current request from
+config.app.current_request instead. Responses returned by operation functions are validated with the API's response
+validator, as Connexion would validate them.
+"""
+import re, json, logging
+
+import chalice
+import werkzeug.wrappers
+from connexion.operations import make_operation
+from connexion.decorators.parameter import inspect_function_arguments
+from connexion.decorators.validation import ParameterValidator, RequestBodyValidator
+from connexion.exceptions import ProblemException, NonConformingResponseBody, NonConformingResponseHeaders
+from connexion.lifecycle import ConnexionResponse
+from connexion.problem import problem
+from connexion.utils import is_json_mimetype, is_nullable
+
+logger = logging.getLogger(__name__)
+
+
+def sanitize_argument_name(name):
+    # Equivalent to the argument name sanitizer used by connexion.decorators.parameter.parameter_to_arg
+    return name and re.sub('^[^a-zA-Z_]+', '', re.sub('[^0-9a-zA-Z_]', '', name))
+
+
+class FastRoute:
+    def __init__(self, operation, json_encoder, internal_error):
+        self.operation = operation
+        self.function = operation._resolution.function
+        self.arguments, self.has_kwargs = inspect_function_arguments(self.function)
+        self.json_encoder = json_encoder
+        self.internal_error = internal_error
+        self.body_validator = None
+        if operation.method.upper() in {"PATCH", "POST", "PUT"} and operation.body_schema:
+            self.body_validator = RequestBodyValidator(operation.body_schema, operation.consumes, operation.api,
+                                                       is_nullable(operation.body_definition))
+        self.response_validator = None
+        if operation.validate_responses:
+            self.response_validator = operation.validator_map["response"](operation, operation.get_mimetype())
+
+    def get_body(self, request):
+        """
+        Returns a tuple of a flag that is True if the request body can be handled on the fast path, and the parsed body.
+        """
+        if self.body_validator is None:
+            return True, None
+        if not request.raw_body:
+            return True, None
+        try:
+            if not is_json_mimetype(request.headers.get("content-type", "")):
+                return False, None
+            return True, json.loads(request.raw_body)
+        except ValueError:
+            return False, None
+
+    def __call__(self, request, path_params):
+        """
+        Returns the response to a Chalice request, or None if the request should be dispatched through Connexion.
+        """
+        is_supported, body = self.get_body(request)
+        if not is_supported:
+            return None
+        if self.body_validator is not None and (body is not None or not self.body_validator.has_default):
+            error = self.body_validator.validate_schema(body, request.context["path"])
+            if error is not None:
+                return self.render(error)
+        param_values = {"path": path_params, "query": request.query_params or {}, "header": request.headers}
+        for param in self.operation.parameters:
+            if param["in"] not in param_values:
+                return None
+            error = ParameterValidator.validate_parameter(param["in"], param_values[param["in"]].get(param["name"]),
+                                                          param, param_name=param["name"])
+            if error is not None:
+                return self.render(problem(400, "Bad Request", error))
+        try:
+            kwargs = self.operation.get_arguments(path_params, dict(param_values["query"]), body, {}, self.arguments,
+                                                  self.has_kwargs, sanitize_argument_name)
+            res = self.render(self.function(**kwargs))
+        except ProblemException as e:
+            return self.render(e.to_problem())
+        except Exception as e:
+            return self.render(self.internal_error(e).to_problem())
+        return self.validate_response(request, res)
+
+    def validate_response(self, request, res):
+        sample = getattr(self.response_validator, "sample", None)
+        if self.response_validator is None or (sample is not None and not sample()):
+            return res
+        if not isinstance(res.body, (bytes, str)):
+            res.body = b"".join(chunk.encode() if isinstance(chunk, str) else chunk for chunk in res.body)
+        try:
+            self.response_validator.validate_response(res.body, res.status_code, res.headers, request.context["path"])
+        except (NonConformingResponseBody, NonConformingResponseHeaders) as e:
+            return self.render(problem(500, e.reason, e.message))
+        return res
+
+    def render(self, res):
+        """
+        Converts a value returned by an operation function to a chalice.Response, as Connexion would convert it to a
+        Flask response.
+        """
+        if isinstance(res, werkzeug.wrappers.Response):
+            headers = dict(res.headers)
+            headers.pop("Content-Length", None)
+            return chalice.Response(status_code=res.status_code, headers=headers, body=res.response)
+        status_code, headers, mimetype = 200, {}, "application/json"
+        if isinstance(res, ConnexionResponse):
+            body, status_code, headers, mimetype = res.body, res.status_code, dict(res.headers), res.mimetype
+        elif isinstance(res, tuple):
+            body, status_code, headers = (res + ({},))[:3]
+        else:
+            body = res
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body, cls=self.json_encoder) + "\n"
+        headers.setdefault("Content-Type", mimetype)
+        return chalice.Response(status_code=int(status_code), headers=headers, body=body)
+
+
+class FastRouter:
+    def __init__(self, api, json_encoder, internal_error):
+        """
+        :param api: The Connexion API whose operations are compiled into routes
+        :param json_encoder: JSON encoder class used to serialize operation results
+        :param internal_error: Function that returns the ProblemException to respond with when an operation raises an
+                               unexpected exception
+        """
+        self.routes = {}  # type: dict
+        for path, path_item in api.specification["paths"].items():
+            for method in path_item:
+                if method not in {"get", "put", "post", "delete", "patch"}:
+                    continue
+                operation = make_operation(api.specification, api, path, method, api.resolver,
+                                           validate_responses=api.validate_responses,
+                                           validator_map=api.validator_map,
+                                           strict_validation=api.strict_validation,
+                                           pythonic_params=api.pythonic_params,
+                                           uri_parser_class=api.options.uri_parser_class,
+                                           pass_context_arg_name=api.pass_context_arg_name)
+                self.routes[api.base_path + path, method.upper()] = FastRoute(operation, json_encoder, internal_error)
+
+    def get(self, resource_path, method):
+        return self.routes.get((resource_path, method))
@@ -0,0 +1,207 @@
+"""
+Storage for async query job status documents and the job index.
+
+The job store is selected by config.job_store_url: an s3://bucket/prefix/ URL, a sqlite:// URL (sqlite:// alone for an
+in-process database, or sqlite:///path/to/file), or a local directory path. If it is not set, job status is stored in
+the service S3 bucket.
+"""
+import os, json, time, uuid, sqlite3, datetime, threading
+from urllib.parse import urlparse
+
+import botocore
+from dcplib.aws import clients
+
+from .. import config
+from . import JSONEncoder
+
+
+class JobStore:
+    """
+    Cancellation is terminal. The cancellation of a job is recorded apart from its status document, and once it has
+    been recorded, the job is reported as cancelled whatever status its worker writes afterwards, so a worker that has
+    not yet noticed the cancellation cannot overwrite it. (S3, the default store, has no conditional writes.)
+    """
+
+    def _get_doc(self, kind, job_id):
+        raise NotImplementedError()
+
+    def _put_doc(self, kind, job_id, doc):
+        raise NotImplementedError()
+
+    def get_status(self, job_id):
+        """
+        Returns the status document of a job, or None if the job does not exist.
+        """
+        job_status_doc = self._get_doc("job_status", job_id)
+        if job_status_doc is not None and job_status_doc["status"] != "cancelled":
+            job_status_doc = self._get_doc("job_cancellation", job_id) or job_status_doc
+        return job_status_doc
+
+    def put_status(self, job_id, job_status_doc):
+        self._put_doc("job_status", job_id, job_status_doc)
+
+    def cancel(self, job_id, job_status_doc):
+        """
+        Records the cancellation of a job, with the status document to report for it from now on.
+        """
+        self._put_doc("job_cancellation", job_id, job_status_doc)
+        self.put_status(job_id, job_status_doc)
+
+    def get_index(self, job_fingerprint):
+        """
+        Returns the ID of the job indexed under a fingerprint and the time it was indexed, or None if there is none.
+        """
+        raise NotImplementedError()
+
+    def put_index(self, job_fingerprint, job_id):
+        raise NotImplementedError()
+
+    def get_result_url(self, result_location):
+        if "Path" in result_location:
+            return "file://" + result_location["Path"]
+        return clients.s3.generate_presigned_url(ClientMethod="get_object",
+                                                 Params=dict(**result_location),
+                                                 ExpiresIn=config.job_result_url_expiration_seconds)
+
+
+class S3JobStore(JobStore):
+    """
+    Stores each job status document and index entry in its own S3 object, read with a single GetObject request.
+    Presigned result URLs are cached until they are within config.job_result_url_refresh_seconds of expiring.
+    """
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket, self.prefix = bucket, prefix
+        self._result_urls = {}  # type: dict
+        self._lock = threading.Lock()
+
+    def _get_object(self, key):
+        try:
+            return clients.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+
+    def _get_doc(self, kind, job_id):
+        doc_object = self._get_object(f"{kind}/{job_id}")
+        return None if doc_object is None else json.load(doc_object["Body"])
+
+    def _put_doc(self, kind, job_id, doc):
+        clients.s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}{kind}/{job_id}",
+                              Body=json.dumps(doc, cls=JSONEncoder).encode())
+
+    def get_index(self, job_fingerprint):
+        job_index_object = self._get_object(f"job_index/{job_fingerprint}")
+        if job_index_object is None:
+            return None
+        return job_index_object["Body"].read().decode(), job_index_object["LastModified"]
+
+    def put_index(self, job_fingerprint, job_id):
+        clients.s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}job_index/{job_fingerprint}", Body=job_id.encode())
+
+    def get_result_url(self, result_location):
+        if "Path" in result_location:
+            return super().get_result_url(result_location)
+        cache_key = (result_location["Bucket"], result_location["Key"])
+        with self._lock:
+            result_url, expires_at = self._result_urls.get(cache_key, (None, 0))
+        if time.time() > expires_at - config.job_result_url_refresh_seconds:
+            expires_at = time.time() + config.job_result_url_expiration_seconds
+            result_url = super().get_result_url(result_location)
+            with self._lock:
+                self._result_urls[cache_key] = result_url, expires_at
+        return result_url
+
+
+class LocalDirJobStore(JobStore):
+    def __init__(self, path):
+        self.path = path
+        for subdir in "job_status", "job_cancellation", "job_index":
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    def _write(self, key, data):
+        tmp_path = os.path.join(self.path, f"{key}.{uuid.uuid4()}.partial")
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.rename(tmp_path, os.path.join(self.path, key))
+
+    def _get_doc(self, kind, job_id):
+        try:
+            with open(os.path.join(self.path, kind, job_id)) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def _put_doc(self, kind, job_id, doc):
+        self._write(f"{kind}/{job_id}", json.dumps(doc, cls=JSONEncoder).encode())
+
+    def get_index(self, job_fingerprint):
+        path = os.path.join(self.path, "job_index", job_fingerprint)
+        try:
+            with open(path) as fh:
+                job_id = fh.read()
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        return job_id, datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+
+    def put_index(self, job_fingerprint, job_id):
+        self._write(f"job_index/{job_fingerprint}", job_id.encode())
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Stores job status in a SQLite database, which is kept in memory if path is None.
+    """
+
+    def __init__(self, path=None):
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            for kind in "job_status", "job_cancellation":
+                self._db.execute(f"CREATE TABLE IF NOT EXISTS {kind} (job_id TEXT PRIMARY KEY, doc TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS job_index "
+                             "(job_fingerprint TEXT PRIMARY KEY, job_id TEXT, indexed_at REAL)")
+
+    def _fetch_one(self, query, params):
+        with self._lock:
+            return self._db.execute(query, params).fetchone()
+
+    def _get_doc(self, kind, job_id):
+        row = self._fetch_one(f"SELECT doc FROM {kind} WHERE job_id = ?", (job_id,))
+        return None if row is None else json.loads(row[0])
+
+    def _put_doc(self, kind, job_id, doc):
+        with self._lock, self._db:
+            self._db.execute(f"INSERT OR REPLACE INTO {kind} VALUES (?, ?)", (job_id, json.dumps(doc, cls=JSONEncoder)))
+
+    def get_index(self, job_fingerprint):
+        row = self._fetch_one("SELECT job_id, indexed_at FROM job_index WHERE job_fingerprint = ?", (job_fingerprint,))
+        if row is None:
+            return None
+        return row[0], datetime.datetime.fromtimestamp(row[1], datetime.timezone.utc)
+
+    def put_index(self, job_fingerprint, job_id):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO job_index VALUES (?, ?, ?)",
+                             (job_fingerprint, job_id, time.time()))
+
+
+def open_job_store(url):
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == "s3":
+        return S3JobStore(parsed_url.netloc, parsed_url.path.lstrip("/"))
+    if parsed_url.scheme == "sqlite":
+        return SQLiteJobStore(parsed_url.path or None)
+    return LocalDirJobStore(url)
+
+
+_job_stores = {}  # type: dict
+
+
+def get_job_store():
+    url = config.job_store_url or f"s3://{config.s3_bucket_name}/"
+    if url not in _job_stores:
+        _job_stores[url] = open_job_store(url)
+    return _job_stores[url]
@@ -1,29 +1,151 @@
-import json
+import io, uuid, logging
 
 import requests
-from flask import redirect
+from flask import redirect, Response
+from werkzeug.http import parse_accept_header
 
-from dcpquery.api import JSONEncoder
 from .. import config
 from ..exceptions import QueryTimeoutError, QuerySizeError
-from ..db import run_query
+from ..db import run_query, estimate_query_cost
 from .query_job import create_async_query_job
+from .query_jobs import write_job_result
+from .result_writers import result_writers, JSONResultWriter
+from .result_cache import query_result_cache
+from .compression import CompressingBuffer, choose_content_encoding, cache_compressed_body
+
+logger = logging.getLogger(__name__)
+
+
+def exceeds_sync_query_limits(query, params):
+    estimate = estimate_query_cost(query, params)
+    if estimate is None:
+        return False
+    total_cost, plan_rows = estimate
+    if config.sync_query_max_estimated_cost is not None and total_cost > config.sync_query_max_estimated_cost:
+        return True
+    if config.sync_query_max_estimated_rows is not None and plan_rows > config.sync_query_max_estimated_rows:
+        return True
+    return False
+
+
+def redirect_to_query_job(job_id):
+    return redirect(f"query_jobs/{job_id}?redirect_when_waiting=true&redirect_when_done=true")
+
+
+def redirect_to_async_query_job(query, params, output_format="json"):
+    return redirect_to_query_job(create_async_query_job(query, params, output_format=output_format))
+
+
+def hand_off_to_query_job(query, params, cursor, encoded_rows, row_count, output_format="json"):
+    """
+    Writes the rows already fetched and encoded by the sync path, followed by the remainder of its open cursor, to the
+    job result store. This saves the async query worker from executing the query again from the start. The
+    cursor keeps the time limit of the sync query, so a hand-off that would outlast the API request raises
+    QueryTimeoutError.
+    """
+    job_id = str(uuid.uuid4())
+    write_job_result(job_id, query, params, cursor, encoded_rows=encoded_rows, encoded_row_count=row_count,
+                     output_format=output_format)
+    return job_id
+
+
+def get_response_content_encoding(size=None):
+    """
+    Returns the content encoding and level that a sync query result is compressed with while it is encoded, or
+    (None, None) if the client does not accept a compressed response. Results are compressed at the level used for the
+    smallest bodies, since the compression ratio decides whether a result fits in a sync response. If a size is given,
+    returns the content encoding and level that the response encoder uses for a body of that size instead.
+    """
+    accept_encoding = parse_accept_header(config.app.current_request.headers.get("Accept-Encoding"))
+    return choose_content_encoding(accept_encoding, config.response_compression_min_size if size is None else size)
+
+
+def execute_query(query, params, output_format, cache_key=None, content_encoding=None, level=None):
+    if content_encoding is None:
+        result = io.BytesIO()
+        max_size = config.API_GATEWAY_MAX_RESULT_SIZE
+    else:
+        result = CompressingBuffer(content_encoding, level, max_compressed_size=config.API_GATEWAY_MAX_RESULT_SIZE)
+        max_size = config.sync_query_max_uncompressed_result_size
+    # Results too large for a sync response are stored by the async query job in a comparable format.
+    async_output_format = "parquet" if output_format == "arrow" else output_format
+    try:
+        if exceeds_sync_query_limits(query, params):
+            return redirect_to_async_query_job(query, params, output_format=async_output_format)
+        with run_query(query, params) as cursor:
+            writer_class = result_writers[output_format]
+            if issubclass(writer_class, JSONResultWriter):
+                writer = writer_class(result, header=dict(query=query, params=params), cursor=cursor,
+                                      max_size=max_size)
+            else:
+                writer = writer_class(result, cursor=cursor, max_size=max_size)
+            try:
+                if isinstance(writer, JSONResultWriter):
+                    # Rows are consumed one at a time, so a query that is handed off resumes at the first unwritten row
+                    for row in cursor:
+                        writer.write_row(row)
+                else:
+                    for rows in cursor.pages():
+                        writer.write_rows(rows)
+                # Check the size of any compressed output still buffered while the result can still be handed off
+                result.flush()
+            except QuerySizeError:
+                if not config.sync_query_handoff or not isinstance(writer, JSONResultWriter):
+                    raise
+                try:
+                    encoded_rows = result.getvalue()[writer.header_size:]
+                    return redirect_to_query_job(hand_off_to_query_job(query, params, cursor, encoded_rows,
+                                                                       writer.rows_written, output_format))
+                except QueryTimeoutError as e:
+                    logger.info("Unable to hand off query to async job, re-executing it asynchronously: %s", e)
+                    raise
+            writer.close()
+            body = result.getvalue()
+            if content_encoding is not None:
+                # The response is returned uncompressed so it can be validated, and its compressed form is handed over
+                # through the compressed body cache to the response encoder, if it compresses the body the same way.
+                compressed_body = result.compressed_value()
+                if get_response_content_encoding(len(body))[0] == content_encoding:
+                    cache_compressed_body(body, content_encoding, compressed_body)
+                if cache_key is not None:
+                    query_result_cache.put(f"{cache_key}.{content_encoding}", compressed_body)
+    except (QuerySizeError, QueryTimeoutError):
+        return redirect_to_async_query_job(query, params, output_format=async_output_format)
+    if cache_key is not None:
+        query_result_cache.put(cache_key, body)
+    return Response(status=requests.codes.ok, mimetype=writer.content_type, response=body,
+                    headers={"X-Cache": "bypass" if cache_key is None else "miss"})
+
+
+def fits_sync_response(cache_key, cached_result, content_encoding):
+    """
+    Returns True if a cached query result fits in a sync response. A result that only fits once compressed is served
+    only if its compressed form for the response's content encoding was cached with it and fits; that form is then
+    passed to the response encoder, which would otherwise compress the result again, at a level chosen for speed.
+    """
+    if len(cached_result) <= config.API_GATEWAY_MAX_RESULT_SIZE:
+        return True
+    if content_encoding is None:
+        return False
+    compressed_result = query_result_cache.get(f"{cache_key}.{content_encoding}")
+    if compressed_result is None or len(compressed_result) > config.API_GATEWAY_MAX_RESULT_SIZE:
+        return False
+    cache_compressed_body(cached_result, content_encoding, compressed_result)
+    return True
 
 
 def post(body):
     query, params = body["query"], body.get("params", {})
+    output_format = body.get("output_format", "json")
     # FIXME: make sure tests include readonly enforcement
     # TODO: for async query, introduce hidden parameter for seconds to wait for S3 to settle
-    try:
-        results = []
-        total_result_size = 0
-        for row in run_query(query, params):
-            result = dict(row.items())
-            total_result_size += len(json.dumps(result, cls=JSONEncoder)) + 2
-            results.append(result)
-            if total_result_size > config.API_GATEWAY_MAX_RESULT_SIZE:
-                raise QuerySizeError()
-    except (QuerySizeError, QueryTimeoutError):
-        job_id = create_async_query_job(query, params)
-        return redirect(f"query_jobs/{job_id}?redirect_when_waiting=true&redirect_when_done=true")
-    return {"query": query, "params": params, "results": results}, requests.codes.ok
+    cache_key = None
+    if query_result_cache.enabled and "no-cache" not in config.app.current_request.headers.get("Cache-Control", ""):
+        cache_key = query_result_cache.key(query, params, output_format)
+    content_encoding, level = get_response_content_encoding()
+    if cache_key is not None:
+        cached_result = query_result_cache.get(cache_key)
+        if cached_result is not None and fits_sync_response(cache_key, cached_result, content_encoding):
+            return Response(status=requests.codes.ok, mimetype=result_writers[output_format].content_type,
+                            response=cached_result, headers={"X-Cache": "hit"})
+    return execute_query(query, params, output_format, cache_key, content_encoding, level)
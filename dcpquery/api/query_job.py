@@ -1,22 +1,109 @@
 import json
 import uuid
+import hashlib
+import logging
 import requests
 
 from dcplib import aws
 
 from .. import config
-from .query_jobs import set_job_status
+from ..db import query_fingerprint, get_data_generation, estimate_query_cost
+from ..exceptions import DCPQueryError
+from .query_jobs import set_job_status, find_job_id, index_job, check_callback_url
 
+logger = logging.getLogger(__name__)
 
-def create_async_query_job(query, params):
-    q = aws.resources.sqs.Queue(aws.clients.sqs.get_queue_url(QueueName=config.async_queries_queue_name)["QueueUrl"])
-    sqs_receipt = q.send_message(MessageBody=json.dumps(dict(query=query, params=params)))
+
+def get_job_fingerprint(query, params, output_format, compression, callback_url=None):
+    """
+    Returns the key that query jobs are indexed under: a hash of the query, its parameters, the job options and the
+    current data generation. Returns None if the data generation is unavailable.
+    """
+    try:
+        data_generation = get_data_generation()
+    except DCPQueryError as e:
+        logger.warning("Unable to get data generation, not indexing query job: %s", e)
+        return None
+    return query_fingerprint(query, params, output_format, compression, callback_url, data_generation)
+
+
+def get_caller():
+    """
+    Returns the identity used to share async query lanes fairly between callers: the authenticated identity of the
+    current API request (Cognito identity, IAM user or API key) if it has one, or else its source IP. Outside of an API
+    request, returns "service", whose jobs run in the internal lane.
+    """
+    if config.app is None or config.app.current_request is None:
+        return "service"
+    identity = config.app.current_request.context.get("identity") or {}
+    for key in "cognitoIdentityId", "userArn", "apiKeyId", "sourceIp":
+        if identity.get(key):
+            return identity[key]
+    return "anonymous"
+
+
+def get_message_group_id(caller, message_body):
+    """
+    Returns the SQS message group of a job: one of config.async_query_message_group_buckets groups of its caller,
+    chosen by a hash of the job. Jobs in a message group run one at a time, so this lets a caller (e.g. all clients
+    behind a NAT) run a few jobs at once, while a caller with a backlog of jobs still cannot hold up other callers.
+    """
+    bucket = int(hashlib.sha256(message_body.encode()).hexdigest(), 16) % config.async_query_message_group_buckets
+    return "{}-{}".format(hashlib.sha256(caller.encode()).hexdigest()[:32], bucket)
+
+
+def choose_lane(query, params, caller):
+    if caller == "service":
+        return "internal"
+    estimate = estimate_query_cost(query, params)
+    if estimate is not None and estimate[0] > config.async_query_bulk_min_estimated_cost:
+        return "bulk"
+    return "interactive"
+
+
+def create_async_query_job(query, params, output_format="json", compression=None, force=False, caller=None,
+                           callback_url=None):
+    """
+    Enqueues a query job and returns its ID. If an identical job for the current data generation is new or running, or
+    finished within the result retention period, its ID is returned instead, unless force is set. Identical jobs
+    submitted at the same moment may still both be enqueued.
+
+    The job is queued in the lane chosen for its estimated cost and caller, in one of its caller's message groups (see
+    get_message_group_id). The caller defaults to the identity of the current API request (see get_caller). If
+    callback_url is set, the final job status is POSTed to it when the job finishes; jobs are only reused for identical
+    queries with the same callback URL.
+    """
+    job_fingerprint = None
+    if config.coalesce_queries:
+        job_fingerprint = get_job_fingerprint(query, params, output_format, compression, callback_url)
+        if job_fingerprint is not None and not force:
+            job_id = find_job_id(job_fingerprint)
+            if job_id is not None:
+                return job_id
+    caller = caller or get_caller()
+    lane = choose_lane(query, params, caller)
+    queue_name = config.get_async_queries_queue_name(lane)
+    q = aws.resources.sqs.Queue(aws.clients.sqs.get_queue_url(QueueName=queue_name)["QueueUrl"])
+    message = dict(query=query, params=params, output_format=output_format, compression=compression, lane=lane,
+                   callback_url=callback_url)
+    message_body = json.dumps(message)
+    sqs_receipt = q.send_message(MessageBody=message_body,
+                                 MessageGroupId=get_message_group_id(caller, message_body),
+                                 MessageDeduplicationId=str(uuid.uuid4()))
     job_id = sqs_receipt["MessageId"]
-    set_job_status(job_id=job_id, status="new")
+    set_job_status(job_id=job_id, status="new", lane=lane)
+    if job_fingerprint is not None:
+        index_job(job_fingerprint, job_id)
     return job_id
 
 
 def post(body):
     query, params = body["query"], body.get("params", {})
-    job_id = create_async_query_job(query, params)
-    return {"query": query, "params": params, "job_id": job_id}, requests.codes.accepted
+    output_format, compression = body.get("output_format", "json"), body.get("compression")
+    callback_url = body.get("callback_url")
+    if callback_url is not None:
+        check_callback_url(callback_url, resolve=False)
+    job_id = create_async_query_job(query, params, output_format=output_format, compression=compression,
+                                    force=body.get("force", False), callback_url=callback_url)
+    return dict(query=query, params=params, output_format=output_format, compression=compression,
+                callback_url=callback_url, job_id=job_id), requests.codes.accepted
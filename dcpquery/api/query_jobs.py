@@ -1,80 +1,503 @@
-import os, sys, json
+import os, sys, json, time, socket, logging, datetime, ipaddress, threading
+from concurrent.futures import ThreadPoolExecutor
 
-import botocore, requests
-from dcplib import aws
+import requests
+from requests.adapters import HTTPAdapter
 from flask import Response
-from urllib.parse import urlencode
-from dcplib.aws import clients, resources
+from urllib.parse import urlencode, urlsplit
+from requests_http_signature import HTTPSignatureAuth
+from dcplib.aws import clients
 
-from dcpquery.db import run_query
-from dcpquery.exceptions import DCPQueryError
+from dcpquery.db import run_query, estimate_query_cost
+from dcpquery.exceptions import DCPQueryError, QueryCancelledError
 from .. import config
 from . import JSONEncoder
+from .result_writers import result_writers, JSONResultWriter
+from .uploads import open_job_result_upload
+from .job_store import get_job_store
 
+logger = logging.getLogger(__name__)
 
-def get(job_id, redirect_when_waiting=False, redirect_when_done=False):
-    bucket = resources.s3.Bucket(config.s3_bucket_name)
-    job_status_object = bucket.Object(f"job_status/{job_id}")
-    try:
-        job_status_object.load()
-        job_status = json.load(job_status_object.get()["Body"])
-    except botocore.exceptions.ClientError as e:
-        if "Not Found" in str(e):
-            return Response(status=requests.codes.not_found, response=b"{}")
-        raise
+
+def get_job_status(job_id):
+    return get_job_store().get_status(job_id)
+
+
+def wait_for_job_status_change(job_id, job_status, wait_seconds):
+    """
+    Polls the status of a new or running job until it changes or wait_seconds have passed, and returns the latest
+    job status document. The poll interval doubles after each poll, up to config.query_job_max_poll_interval_seconds,
+    so a long wait costs a few job store reads and not one per second.
+    """
+    deadline = time.time() + min(wait_seconds, config.query_job_max_wait_seconds)
+    poll_interval = config.query_job_poll_interval_seconds
+    while job_status["status"] in {"new", "running"} and time.time() < deadline:
+        time.sleep(min(poll_interval, max(deadline - time.time(), 0)))
+        poll_interval = min(poll_interval * 2, config.query_job_max_poll_interval_seconds)
+        latest_job_status = get_job_status(job_id)
+        if latest_job_status is None:
+            break
+        if latest_job_status["status"] != job_status["status"]:
+            return latest_job_status
+        job_status = latest_job_status
+    return job_status
+
+
+def get_retry_after(job_status):
+    """
+    Returns the number of seconds a client should wait before polling a new or running job again. If the job has
+    reported progress, this is an estimate of the time remaining based on its fetch rate and the planner's row
+    estimate. Otherwise, it grows with the time the job has been running.
+    """
+    progress = job_status.get("progress") or {}
+    elapsed_seconds = progress.get("elapsed_seconds", 0)
+    rows_fetched, estimated_rows = progress.get("rows_fetched", 0), progress.get("estimated_rows")
+    if rows_fetched and estimated_rows and elapsed_seconds:
+        retry_after = max(estimated_rows - rows_fetched, 0) / (rows_fetched / elapsed_seconds)
+    else:
+        retry_after = elapsed_seconds / 4
+    retry_after = max(retry_after, config.query_job_min_retry_after_seconds)
+    return int(min(retry_after, config.query_job_max_retry_after_seconds))
+
+
+def get(job_id, redirect_when_waiting=False, redirect_when_done=False, wait=0):
+    job_status = get_job_status(job_id)
+    if job_status is None:
+        return Response(status=requests.codes.not_found, response=b"{}")
+    if wait:
+        job_status = wait_for_job_status_change(job_id, job_status, wait)
+    job_status = describe_job(job_status)
     if job_status["status"] in {"new", "running"} and redirect_when_waiting:
         return Response(status=requests.codes.moved,
                         headers={"Location": job_id + "?" + urlencode(config.app.current_request.query_params),
-                                 "Retry-After": "60",
+                                 "Retry-After": str(get_retry_after(job_status)),
                                  "Content-Type": "application/json"},
                         response=json.dumps(job_status).encode())
+    if job_status.get("result_url") is not None and redirect_when_done:
+        # A result stored in several chunks can't be served by a single redirect, so redirect to the chunk list
+        location = job_status["result_url"] if job_status["result_chunk_count"] == 1 else f"{job_id}/results"
+        return Response(status=requests.codes.found,
+                        headers={"Location": location, "Content-Type": "application/json"},
+                        response=json.dumps(job_status).encode())
+    return job_status
+
+
+def describe_job(job_status):
+    """
+    Turns a stored job status document into the job description returned to clients, with a download URL for the
+    result in place of the chunk list.
+    """
     if job_status.get("result_location") is not None:
-        result_url = clients.s3.generate_presigned_url(ClientMethod="get_object",
-                                                       Params=dict(**job_status["result_location"]),
-                                                       ExpiresIn=60 * 60 * 24 * 7)
-        job_status["result_url"] = result_url
-        if redirect_when_done:
-            return Response(status=requests.codes.found,
-                            headers={"Location": result_url, "Content-Type": "application/json"},
-                            response=json.dumps(job_status).encode())
+        job_status["result_url"] = get_job_store().get_result_url(job_status["result_location"])
+        job_status["result_chunk_count"] = len(job_status.pop("result_chunks", None) or [None])
     return job_status
 
 
-def set_job_status(job_id, status, error=None, result_location=None):
-    bucket = aws.resources.s3.Bucket(config.s3_bucket_name)
-    job_status_object = bucket.Object(f"job_status/{job_id}")
+def get_results(job_id, offset=0, limit=None):
+    """
+    Returns download URLs for the chunks of a job result that contain the rows from offset to offset + limit.
+    """
+    job_status = get_job_status(job_id)
+    if job_status is None:
+        return Response(status=requests.codes.not_found, response=b"{}")
+    if job_status["status"] != "done":
+        raise DCPQueryError(status=requests.codes.conflict, title="Job results are not available",
+                            detail=f"Job {job_id} is {job_status['status']}")
+    result_chunks = job_status.get("result_chunks") or [dict(row_offset=0,
+                                                             row_count=job_status.get("result_row_count"),
+                                                             byte_offset=0,
+                                                             size=job_status.get("result_size"),
+                                                             location=job_status["result_location"])]
+    chunks = []
+    for chunk in result_chunks:
+        if limit is not None and chunk["row_offset"] >= offset + limit:
+            break
+        if chunk["row_count"] is None or chunk["row_offset"] + chunk["row_count"] > offset:
+            chunk = dict(chunk, url=get_job_store().get_result_url(chunk["location"]))
+            del chunk["location"]
+            chunks.append(chunk)
+    return dict(job_id=job_id, result_row_count=job_status.get("result_row_count"), chunks=chunks)
+
+
+def delete(job_id):
+    """
+    Cancels a new or running job. The cancellation is final (see JobStore.cancel): the job worker cancels the job's
+    query on its database connection and stops fetching its results the next time it checks the job status.
+    """
+    job_status = get_job_status(job_id)
+    if job_status is None:
+        return Response(status=requests.codes.not_found, response=b"{}")
+    if job_status["status"] not in {"new", "running"}:
+        raise DCPQueryError(status=requests.codes.conflict, title="Job is not running",
+                            detail=f"Job {job_id} is {job_status['status']}")
+    get_job_store().cancel(job_id, make_job_status_doc(job_id, status="cancelled", progress=job_status.get("progress"),
+                                                       lane=job_status.get("lane")))
+    return dict(job_id=job_id, status="cancelled", error=None, result_location=None)
+
+
+def make_job_status_doc(job_id, status, error=None, result_location=None, result_row_count=None, result_size=None,
+                        result_chunks=None, progress=None, lane=None):
     job_status_doc = {"job_id": job_id, "status": status, "error": error, "result_location": result_location}
-    job_status_object.put(Body=json.dumps(job_status_doc, cls=JSONEncoder).encode())
-    return {"Bucket": bucket.name, "Key": job_status_object.key}
+    if lane is not None:
+        job_status_doc.update(lane=lane)
+    if result_location is not None:
+        job_status_doc.update(result_row_count=result_row_count, result_size=result_size, result_chunks=result_chunks)
+    if progress is not None:
+        job_status_doc.update(progress=progress)
+    return job_status_doc
+
+
+def set_job_status(job_id, status, **kwargs):
+    job_status_doc = make_job_status_doc(job_id, status, **kwargs)
+    get_job_store().put_status(job_id, job_status_doc)
+    return job_status_doc
+
+
+def find_job_id(job_fingerprint):
+    """
+    Returns the ID of the job indexed under this fingerprint if it is new or running, or if it is done and was submitted
+    within the result retention period. Otherwise, returns None.
+    """
+    job_index_entry = get_job_store().get_index(job_fingerprint)
+    if job_index_entry is None:
+        return None
+    job_id, indexed_at = job_index_entry
+    job_status = get_job_status(job_id)
+    if job_status is None:
+        return None
+    if job_status["status"] in {"new", "running"}:
+        return job_id
+    job_age = datetime.datetime.now(datetime.timezone.utc) - indexed_at
+    if job_status["status"] == "done" and job_age.total_seconds() < config.query_job_result_retention_seconds:
+        return job_id
+    return None
+
+
+def index_job(job_fingerprint, job_id):
+    get_job_store().put_index(job_fingerprint, job_id)
+
+
+class JobProgress:
+    """
+    Publishes the progress of a running job to its status document, at most once per
+    config.query_job_progress_interval_seconds, and watches for the job to be cancelled.
+
+    Once the job's query is running, a watcher thread checks the job status every
+    config.query_job_cancel_check_interval_seconds. When it finds the job cancelled, it cancels the statement running on
+    the job's database connection (see QueryCursor.cancel), and the next progress update raises QueryCancelledError.
+    """
+
+    def __init__(self, job_id, estimated_rows=None, lane=None):
+        self.job_id = job_id
+        self.lane = lane
+        self.estimated_rows = estimated_rows
+        self.start_time = time.time()
+        self.last_update_time = None
+        self.cancelled = threading.Event()
+        self._stopped = threading.Event()
+
+    def connected(self, cursor):
+        self.update("executing", force=True)
+        threading.Thread(target=self.watch, args=(cursor,), daemon=True).start()
+
+    def check_cancelled(self):
+        if not self.cancelled.is_set():
+            job_status = get_job_status(self.job_id)
+            if job_status is not None and job_status["status"] == "cancelled":
+                self.cancelled.set()
+        return self.cancelled.is_set()
+
+    def watch(self, cursor):
+        while not self._stopped.wait(config.query_job_cancel_check_interval_seconds):
+            try:
+                if self.check_cancelled():
+                    cursor.cancel()
+            except Exception as e:
+                logger.warning("Unable to check whether job %s was cancelled: %s", self.job_id, e)
 
+    def stop(self):
+        self._stopped.set()
 
-def set_job_result(job_id, query, params, result, error=None):
-    bucket = aws.resources.s3.Bucket(config.s3_bucket_name)
-    job_result_object = bucket.Object(f"job_result/{job_id}")
-    job_result_doc = dict(job_id=job_id, status="done", query=query, params=params, result=result, error=error)
-    job_result_object.put(Body=json.dumps(job_result_doc, cls=JSONEncoder).encode())
-    return {"Bucket": bucket.name, "Key": job_result_object.key}
+    def update(self, phase, rows_fetched=0, bytes_written=0, force=False):
+        if self.cancelled.is_set():
+            raise QueryCancelledError(title="Query job was cancelled", detail=self.job_id)
+        now = time.time()
+        if force or self.last_update_time is None or \
+                now - self.last_update_time >= config.query_job_progress_interval_seconds:
+            progress = dict(phase=phase, rows_fetched=rows_fetched, bytes_written=bytes_written,
+                            elapsed_seconds=round(now - self.start_time, 1), estimated_rows=self.estimated_rows)
+            set_job_status(self.job_id, status="running", progress=progress, lane=self.lane)
+            self.last_update_time = now
 
 
-def process_async_query(event_record):
+def write_job_result(job_id, query, params, cursor, encoded_rows=b"", encoded_row_count=0, output_format="json",
+                     compression=None, progress=None, lane=None):
+    """
+    Streams the rows of an open query cursor to the job result store while they are being fetched, and marks the job
+    done. Rows already encoded by a JSONResultWriter (e.g. by a sync query that is being handed off) can be passed in
+    encoded_rows to be written ahead of the remaining rows.
+
+    Results are stored in chunks of up to config.job_result_chunk_rows rows, each a complete document in the requested
+    output format. The first chunk is stored under the job ID and the rest under <job ID>.<chunk number>. The job status
+    lists the row offset, row count, byte offset, size and location of each chunk.
+    """
+    writer_class = result_writers[output_format]
+    put_object_args = dict(ContentType=writer_class.content_type)
+    if compression is not None and not writer_class.compresses_internally:
+        put_object_args.update(ContentEncoding=compression)
+
+    def open_chunk_writer(upload):
+        if issubclass(writer_class, JSONResultWriter):
+            return writer_class(upload,
+                                header=dict(job_id=job_id, status="done", query=query, params=params, error=None),
+                                results_key="result",
+                                cursor=cursor,
+                                content_encoding=compression)
+        return writer_class(upload, cursor=cursor, content_encoding=compression)
+
+    result_chunks = []  # type: list
+    row_count, size = 0, 0
+    chunk_rows = config.job_result_chunk_rows
+    upload = open_job_result_upload(job_id, **put_object_args)
+    try:
+        writer = open_chunk_writer(upload)
+        if isinstance(writer, JSONResultWriter):
+            writer.write_encoded_rows(encoded_rows, encoded_row_count)
+        for rows in cursor.pages():
+            while rows:
+                if chunk_rows is not None and writer.rows_written >= chunk_rows:
+                    writer.close()
+                    result_chunks.append(dict(row_offset=row_count, row_count=writer.rows_written, byte_offset=size,
+                                              size=upload.size, location=upload.close()))
+                    row_count, size = row_count + writer.rows_written, size + upload.size
+                    upload = open_job_result_upload(f"{job_id}.{len(result_chunks)}", **put_object_args)
+                    writer = open_chunk_writer(upload)
+                page_rows = len(rows) if chunk_rows is None else chunk_rows - writer.rows_written
+                writer.write_rows(rows[:page_rows])
+                rows = rows[page_rows:]
+            if progress is not None:
+                progress.update("fetching", row_count + writer.rows_written, size + upload.size)
+        writer.close()
+        if progress is not None:
+            progress.update("uploading", row_count + writer.rows_written, size + upload.size, force=True)
+        result_chunks.append(dict(row_offset=row_count, row_count=writer.rows_written, byte_offset=size,
+                                  size=upload.size, location=upload.close()))
+    except BaseException:
+        upload.abort()
+        raise
+    return set_job_status(job_id, status="done", result_location=result_chunks[0]["location"],
+                          result_row_count=row_count + writer.rows_written, result_size=size + upload.size,
+                          result_chunks=result_chunks, lane=lane)
+
+
+def process_async_query(event_record, lane="interactive", deadline=None):
     job_id = event_record["messageId"]
-    set_job_status(job_id, status="running")
     event = json.loads(event_record["body"])
     query, params = event["query"], event["params"]
+    timeout_seconds = config.async_query_lanes[lane]["timeout_seconds"]
+    progress = None
     try:
-        results = []
-        total_result_size = 0
-        config.reset_db_timeout_seconds(880)
-        for result in run_query(query, params):
-            total_result_size += len(json.dumps(result, cls=JSONEncoder))
-            results.append(result)
-            if total_result_size > config.S3_SINGLE_UPLOAD_MAX_SIZE:
-                # TODO stream large query results to s3
-                break
-        job_result_location = set_job_result(job_id, query=query, params=params, result=results)
-        set_job_status(job_id, status="done", result_location=job_result_location)
+        estimate = estimate_query_cost(query, params)
+        progress = JobProgress(job_id, estimated_rows=None if estimate is None else estimate[1], lane=lane)
+        if progress.check_cancelled():
+            raise QueryCancelledError(title="Query job was cancelled", detail=job_id)
+        with run_query(query, params, rows_per_page=config.async_query_fetch_size, timeout_seconds=timeout_seconds,
+                       application_name=f"{config.app_name}-job-{job_id}", on_connect=progress.connected) as cursor:
+            job_status = write_job_result(job_id, query, params, cursor,
+                                          output_format=event.get("output_format", "json"),
+                                          compression=event.get("compression"), progress=progress, lane=lane)
+    except QueryCancelledError:
+        job_status = set_job_status(job_id, status="cancelled", lane=lane)
     except DCPQueryError as e:
-        set_job_status(job_id, status="failed", error=e.to_problem().body)
+        job_status = set_job_status(job_id, status="failed", error=e.to_problem().body, lane=lane)
     except Exception as e:
+        # Other errors (e.g. losing the database connection, or failing to upload the result) may be transient, so
+        # until its last delivery, the job is reset to new and the error is raised to leave its message on the queue
+        if int(event_record.get("attributes", {}).get("ApproximateReceiveCount", 1)) < config.async_query_max_receives:
+            set_job_status(job_id, status="new", lane=lane)
+            raise
         problem = DCPQueryError(status=500, title="Async query internal error", detail=str(e)).to_problem().body
-        set_job_status(job_id, status="failed", error=problem)
+        job_status = set_job_status(job_id, status="failed", error=problem, lane=lane)
+    finally:
+        if progress is not None:
+            progress.stop()
+    if event.get("callback_url") is not None:
+        # The job may have been cancelled after its worker last checked, in which case it is reported as cancelled
+        job_status = get_job_status(job_id) or job_status
+        send_job_callback(event["callback_url"], describe_job(job_status), deadline=deadline)
+
+
+def check_callback_url(callback_url, resolve=True):
+    """
+    Raises DCPQueryError unless a job callback URL is an https URL whose host is, or with resolve set resolves to, only
+    public addresses, so that callbacks cannot be used to reach hosts inside the service's network. Returns the checked
+    addresses, which are empty for a host name that was not resolved.
+    """
+    try:
+        url = urlsplit(callback_url)
+        port = url.port or 443
+    except ValueError as e:
+        raise DCPQueryError(status=requests.codes.bad_request, title="Invalid callback URL", detail=str(e))
+    if url.scheme != "https" or not url.hostname:
+        raise DCPQueryError(status=requests.codes.bad_request, title="Invalid callback URL",
+                            detail="Callback URLs must be https URLs")
+    try:
+        addresses = [ipaddress.ip_address(url.hostname)]
+    except ValueError:
+        addresses = []
+        if resolve:
+            try:
+                addresses = [ipaddress.ip_address(addrinfo[4][0].split("%")[0])
+                             for addrinfo in socket.getaddrinfo(url.hostname, port, proto=socket.IPPROTO_TCP)]
+            except socket.gaierror as e:
+                raise DCPQueryError(status=requests.codes.bad_request, title="Invalid callback URL",
+                                    detail=f"Unable to resolve {url.hostname}: {e}")
+    for address in addresses:
+        if getattr(address, "ipv4_mapped", None) is not None:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise DCPQueryError(status=requests.codes.bad_request, title="Invalid callback URL",
+                                detail=f"Callback URL host {url.hostname} is not a public address")
+    return addresses
+
+
+class PinnedAddressAdapter(HTTPAdapter):
+    """
+    Transport adapter that connects to the given address instead of resolving the host in the request URL again, while
+    still sending that host name in SNI and verifying the server's certificate against it.
+    """
+
+    def __init__(self, hostname, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, server_hostname=self.hostname, assert_hostname=self.hostname, **kwargs)
+
+
+def post_to_address(url, address, headers, **kwargs):
+    """
+    POSTs to an https URL at an address its host was already resolved to and checked at (see check_callback_url), so
+    that the host cannot be rebound to a different address in between. The request keeps the URL's Host header, and
+    redirects are not followed.
+    """
+    url = urlsplit(url)
+    port = url.port or 443
+    host = f"[{url.hostname}]" if ":" in url.hostname else url.hostname
+    netloc = f"[{address}]" if address.version == 6 else str(address)
+    headers = dict(headers, Host=host if port == 443 else f"{host}:{port}")
+    with requests.Session() as session:
+        # Proxies configured in the environment would resolve the host themselves
+        session.trust_env = False
+        session.mount("https://", PinnedAddressAdapter(url.hostname))
+        return session.post(url._replace(netloc=f"{netloc}:{port}").geturl(), headers=headers, allow_redirects=False,
+                            **kwargs)
+
+
+def send_job_callback(callback_url, job_status, deadline=None):
+    """
+    POSTs the final description of a job to the callback URL it was submitted with, signed with the active job
+    callback HMAC key. The signature covers the request target, host, date and body digest, and job callback keys are
+    separate from the webhook keys that this service accepts bundle events with.
+
+    The callback URL's host is resolved and checked before each attempt (see check_callback_url), the callback is sent
+    to the checked address (see post_to_address), and redirects are not followed. Failed deliveries are retried with
+    exponential backoff, as long as the retry can finish before the deadline (a time.time() value, e.g. when the Lambda
+    function times out) less config.job_callback_deadline_margin_seconds. Returns True if the callback was delivered.
+    Errors are logged rather than raised, so a failed callback never causes the job to be run again.
+    """
+    if deadline is not None:
+        deadline -= config.job_callback_deadline_margin_seconds
+    try:
+        key_id, key = config.job_callback_key
+        auth = HTTPSignatureAuth(key=key.encode(), key_id=key_id,
+                                 headers=["(request-target)", "host", "date", "digest"])
+        body = json.dumps(job_status, cls=JSONEncoder).encode()
+    except Exception as e:
+        logger.error("Unable to sign callback for job %s: %s", job_status["job_id"], e)
+        return False
+    for attempt in range(config.job_callback_max_attempts):
+        backoff_seconds = config.job_callback_backoff_seconds * 2 ** (attempt - 1) if attempt > 0 else 0
+        if deadline is not None and time.time() + backoff_seconds + config.job_callback_timeout_seconds > deadline:
+            break
+        time.sleep(backoff_seconds)
+        try:
+            address = check_callback_url(callback_url)[0]
+        except DCPQueryError as e:
+            logger.error("Not sending callback for job %s to %s: %s", job_status["job_id"], callback_url, e.detail)
+            return False
+        try:
+            res = post_to_address(callback_url, address, data=body, headers={"Content-Type": "application/json"},
+                                  auth=auth, timeout=config.job_callback_timeout_seconds)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Callback for job %s to %s failed: %s", job_status["job_id"], callback_url, e)
+            continue
+        if res.status_code < 300:
+            return True
+        logger.warning("Callback for job %s to %s failed with status %s", job_status["job_id"], callback_url,
+                       res.status_code)
+        if res.status_code < 500 and res.status_code != requests.codes.too_many_requests:
+            return False
+    logger.error("Giving up on callback for job %s to %s", job_status["job_id"], callback_url)
+    return False
+
+
+def init_async_query_worker(event_records):
+    """
+    Creates the AWS clients, job store and database engine that async query jobs use, and the job callback key if any
+    of the jobs needs it. These are all created when first used, which is not thread-safe (boto3 sessions in
+    particular), so they are created before jobs start running in threads.
+    """
+    for client_name in "s3", "sqs":
+        getattr(clients, client_name)
+    get_job_store()
+    config.db
+    if any(json.loads(event_record["body"]).get("callback_url") for event_record in event_records):
+        try:
+            config.job_callback_key
+        except Exception as e:
+            logger.error("Unable to load job callback key: %s", e)
+
+
+def process_async_queries(event_records, lane="interactive", deadline=None):
+    """
+    Processes a batch of async query SQS messages from a lane's queue, running up to the lane's concurrency of jobs at
+    once on separate database connections. If any job raises (see process_async_query), the messages of the jobs that
+    completed are deleted from the queue and an error is raised, so that SQS only redelivers the failed messages. Job
+    callbacks are not retried past the deadline (see send_job_callback).
+    """
+    config.reset_db_timeout_seconds(config.async_query_lanes[lane]["timeout_seconds"])
+    init_async_query_worker(event_records)
+    with ThreadPoolExecutor(max_workers=config.async_query_lanes[lane]["concurrency"]) as executor:
+        futures = [executor.submit(process_async_query, event_record, lane, deadline) for event_record in event_records]
+    failed_records, completed_records = [], []
+    for event_record, future in zip(event_records, futures):
+        if future.exception() is None:
+            completed_records.append(event_record)
+        else:
+            logger.error("Async query job %s failed: %s", event_record["messageId"], future.exception())
+            failed_records.append(event_record)
+    if failed_records:
+        delete_sqs_messages(config.get_async_queries_queue_name(lane), completed_records)
+        raise DCPQueryError(status=500, title="Async query batch failed",
+                            detail=f"Failed to process {len(failed_records)} of {len(event_records)} async query jobs")
+
+
+def delete_sqs_messages(queue_name, event_records, attempts=2):
+    """
+    Deletes processed messages from a queue. Messages that SQS fails to delete are retried once, and then logged, since
+    they will be delivered again.
+    """
+    queue_url = clients.sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    for i in range(0, len(event_records), 10):
+        entries = [dict(Id=event_record["messageId"], ReceiptHandle=event_record["receiptHandle"])
+                   for event_record in event_records[i:i + 10]]
+        for attempt in range(attempts):
+            failed = clients.sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries).get("Failed", [])
+            failed_ids = {entry["Id"] for entry in failed}
+            entries = [entry for entry in entries if entry["Id"] in failed_ids]
+            if not entries:
+                break
+        for entry in failed:
+            logger.error("Unable to delete message %s from %s: %s %s", entry["Id"], queue_name, entry.get("Code"),
+                         entry.get("Message"))
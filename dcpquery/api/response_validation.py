@@ -0,0 +1,81 @@
+"""
+Sampled validation of API responses against the API spec.
+
+Validating every response, including multi-megabyte query results, against its JSON schema costs more than it is worth
+in production. SampledResponseValidator validates a random sample of responses (config.response_validation_sample_rate),
+and checks response bodies larger than config.response_validation_max_full_size against the top level of their schema
+only, and does not validate bodies larger than config.response_validation_max_size. The time spent validating each
+response is published as the ResponseValidationTime metric, by route.
+"""
+import time, random, functools
+
+from connexion.decorators.response import ResponseValidator
+from connexion.decorators.validation import ResponseBodyValidator
+from connexion.exceptions import NonConformingResponseBody
+from jsonschema import ValidationError
+
+from .. import config
+from ..metrics import put_metric
+
+
+def get_top_level_schema(schema):
+    """
+    Returns a copy of a JSON schema that only constrains the type of a value, its required properties and the types of
+    its properties, without descending into them.
+    """
+    if not isinstance(schema, dict):
+        return schema
+    top_level_schema = {key: schema[key] for key in ("type", "nullable", "x-nullable", "required") if key in schema}
+    if "properties" in schema:
+        top_level_schema["properties"] = {name: {key: prop[key] for key in ("type", "nullable", "x-nullable")
+                                                 if key in prop}
+                                          for name, prop in schema["properties"].items()}
+    if "allOf" in schema:
+        top_level_schema["allOf"] = [get_top_level_schema(s) for s in schema["allOf"]]
+    return top_level_schema
+
+
+class SampledResponseValidator(ResponseValidator):
+    """
+    A Connexion response validator that validates a sample of responses (see module docstring).
+    """
+
+    @property
+    def route(self):
+        return f"{self.operation.method.upper()} {self.operation.path}"
+
+    def sample(self):
+        return random.random() < config.response_validation_sample_rate
+
+    def validate_response(self, data, status_code, headers, url):
+        if data is not None and len(data) > config.response_validation_max_size:
+            return True
+        start_time, mode = time.time(), "full"
+        try:
+            if data is not None and len(data) > config.response_validation_max_full_size:
+                mode = "top_level"
+                return self.validate_top_level(data, status_code, headers, url)
+            return super().validate_response(data, status_code, headers, url)
+        finally:
+            put_metric("ResponseValidationTime", (time.time() - start_time) * 1000, "Milliseconds",
+                       Route=self.route, Mode=mode)
+
+    def validate_top_level(self, data, status_code, headers, url):
+        content_type = headers.get("Content-Type", self.mimetype).rsplit(";", 1)[0]
+        response_schema = self.operation.response_schema(str(status_code), content_type)
+        if self.is_json_schema_compatible(response_schema):
+            validator = ResponseBodyValidator(get_top_level_schema(response_schema), validator=self.validator)
+            try:
+                validator.validate_schema(self.operation.json_loads(data), url)
+            except ValidationError as e:
+                raise NonConformingResponseBody(message=str(e))
+        return True
+
+    def __call__(self, function):
+        validating_function = super().__call__(function)
+
+        @functools.wraps(function)
+        def wrapper(request):
+            return validating_function(request) if self.sample() else function(request)
+
+        return wrapper
@@ -0,0 +1,162 @@
+"""
+Cache of encoded /query results.
+
+Entries are keyed on the exact query text, the query parameters, the output format and the data generation
+number, which the ETL increments whenever it changes the data. Entries from earlier generations are never read again:
+they are evicted from the in-process LRU as newer entries arrive, and expire from the shared store.
+"""
+import os, uuid, logging, threading, collections
+from urllib.parse import urlparse
+
+import botocore
+from dcplib.aws import clients
+
+from .. import config
+from ..db import query_fingerprint, get_data_generation
+from ..exceptions import DCPQueryError
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of byte strings, bounded by the total size of its values.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def pop(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            if len(value) > self.max_size:
+                return
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class LocalDirCacheStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        tmp_path = os.path.join(self.path, f".{key}.{uuid.uuid4()}")
+        with open(tmp_path, "wb") as fh:
+            fh.write(value)
+        os.rename(tmp_path, os.path.join(self.path, key))
+
+
+class S3CacheStore:
+    def __init__(self, bucket, prefix):
+        self.bucket, self.prefix = bucket, prefix
+
+    def get(self, key):
+        try:
+            return clients.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+        except clients.s3.exceptions.NoSuchKey:
+            return None
+
+    def put(self, key, value):
+        clients.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value)
+
+
+def get_shared_store(url):
+    """
+    Returns the shared cache store for an s3://bucket/prefix/ URL or a local directory path, or None if url is None.
+    """
+    if url is None:
+        return None
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == "s3":
+        return S3CacheStore(parsed_url.netloc, parsed_url.path.lstrip("/"))
+    return LocalDirCacheStore(url)
+
+
+class QueryResultCache:
+    def __init__(self):
+        self.local = LRUCache(max_size=config.query_result_cache_size)
+        self._shared_store_url = None
+        self._shared_store = None
+
+    @property
+    def shared_store(self):
+        if self._shared_store_url != config.query_result_cache_url:
+            self._shared_store = get_shared_store(config.query_result_cache_url)
+            self._shared_store_url = config.query_result_cache_url
+        return self._shared_store
+
+    @property
+    def enabled(self):
+        return config.query_result_cache_size > 0 or config.query_result_cache_url is not None
+
+    def key(self, query, params, output_format):
+        """
+        Returns the cache key for a query under the current data generation, or None if the data generation is
+        unavailable.
+        """
+        try:
+            data_generation = get_data_generation()
+        except DCPQueryError as e:
+            logger.warning("Unable to get data generation, not caching query results: %s", e)
+            return None
+        return query_fingerprint(query, params, output_format, data_generation)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared_store is not None:
+            try:
+                value = self.shared_store.get(key)
+            except (OSError, botocore.exceptions.ClientError) as e:
+                logger.warning("Unable to read query result cache entry %s: %s", key, e)
+            if value is not None:
+                self.local.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.local.max_size = config.query_result_cache_size
+        self.local.put(key, value)
+        if self.shared_store is not None:
+            try:
+                self.shared_store.put(key, value)
+            except (OSError, botocore.exceptions.ClientError) as e:
+                logger.warning("Unable to write query result cache entry %s: %s", key, e)
+
+    def clear(self):
+        self.local.clear()
+
+
+query_result_cache = QueryResultCache()
@@ -0,0 +1,336 @@
+"""
+Incremental serializers for query results.
+
+Result writers encode each row exactly once, as it is fetched from the database cursor, and write the encoded bytes to
+a file-like object, optionally compressing them on the fly. Writers keep count of the rows and bytes produced, so
+callers can enforce result size limits without encoding the result a second time.
+"""
+import io, csv, json
+from decimal import Decimal
+
+from ..exceptions import QuerySizeError
+from . import JSONEncoder
+from .compression import get_compressor
+
+
+_json_encoder = JSONEncoder()
+
+
+def encode_text_value(value):
+    """
+    Encodes a column value for text-only output formats. Structured (JSON/JSONB) values are encoded as JSON strings.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list, bool, int, float)):
+        return json.dumps(value, cls=JSONEncoder)
+    return str(_json_encoder.default(value))
+
+
+class ResultWriter:
+    content_type = "application/octet-stream"
+    # If set, the writer applies the requested compression itself, and its output has no content encoding.
+    compresses_internally = False
+
+    def __init__(self, fh, cursor=None, max_size=None, content_encoding=None):
+        """
+        :param fh: File-like object that receives the encoded (and, if requested, compressed) bytes
+        :param cursor: The QueryCursor that rows are read from, used by writers that need column names or types
+        :param max_size: If set, raise QuerySizeError as soon as the encoded result exceeds this many bytes
+        :param content_encoding: If set to "gzip" or "br", compress the output incrementally with this codec
+        """
+        self.fh = fh
+        self.cursor = cursor
+        self.max_size = max_size
+        self.content_encoding = content_encoding
+        self.rows_written = 0
+        self.bytes_written = 0
+        self._compressor = get_compressor(content_encoding)
+
+    def write(self, data):
+        # Data is written before the size check, so rows already counted are never lost when the limit is exceeded.
+        self.bytes_written += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self.fh.write(data)
+        if self.max_size is not None and self.bytes_written > self.max_size:
+            raise QuerySizeError(title="Query result exceeds maximum size", detail=str(self.max_size))
+
+    def write_row(self, row):
+        raise NotImplementedError()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        if self._compressor is not None:
+            self.fh.write(self._compressor.flush())
+            self._compressor = None
+
+
+class JSONResultWriter(ResultWriter):
+    """
+    Writes a JSON document of the form {<header fields>, "results": [<row>, <row>, ...]}.
+    """
+    content_type = "application/json"
+
+    def __init__(self, fh, header=None, results_key="results", **kwargs):
+        super().__init__(fh, **kwargs)
+        doc_start = json.dumps(header or {}, cls=JSONEncoder)[:-1]
+        self.write(f'{doc_start}{", " if header else ""}"{results_key}": ['.encode())
+        self.header_size = self.bytes_written
+
+    def write_row(self, row):
+        encoded_row = json.dumps(row, cls=JSONEncoder)
+        self.rows_written += 1
+        self.write((", " + encoded_row if self.rows_written > 1 else encoded_row).encode())
+
+    def write_encoded_rows(self, encoded_rows, row_count):
+        """
+        Writes rows previously encoded by another JSONResultWriter (the bytes following its header_size offset).
+        """
+        if row_count:
+            self.rows_written += row_count
+            self.write(b", " + encoded_rows if self.rows_written > row_count else encoded_rows)
+
+    def close(self):
+        self.write(b"]}")
+        super().close()
+
+
+class CompactJSONResultWriter(JSONResultWriter):
+    """
+    Writes a JSON document of the form {<header fields>, "columns": [<name>, ...], "results": [[<value>, ...], ...]}.
+    Column names are taken from the cursor and written once, instead of being repeated in every row.
+    """
+
+    def __init__(self, fh, header=None, cursor=None, **kwargs):
+        super().__init__(fh, header=dict(header or {}, columns=list(cursor.keys())), cursor=cursor, **kwargs)
+
+    def write_row(self, row):
+        super().write_row(tuple(row))
+
+
+class NDJSONResultWriter(ResultWriter):
+    """
+    Writes newline-delimited JSON, one row object per line.
+    """
+    content_type = "application/x-ndjson"
+
+    def write_row(self, row):
+        encoded_row = json.dumps(row, cls=JSONEncoder)
+        self.rows_written += 1
+        self.write((encoded_row + "\n").encode())
+
+
+class CSVResultWriter(ResultWriter):
+    """
+    Writes a header line with the column names (taken from the cursor if given, or else from the first row), followed
+    by one line per row. Structured (JSON/JSONB) values are
+    written as JSON strings.
+    """
+    content_type = "text/csv"
+    dialect = "excel"
+
+    def __init__(self, fh, **kwargs):
+        super().__init__(fh, **kwargs)
+        self._line = io.StringIO()
+        self._csv_writer = csv.writer(self._line, dialect=self.dialect)
+        self._header_written = False
+        if self.cursor is not None:
+            self._write_line(self.cursor.keys())
+
+    def _write_line(self, values):
+        self._line.seek(0)
+        self._line.truncate()
+        self._csv_writer.writerow(values)
+        self.write(self._line.getvalue().encode())
+        self._header_written = True
+
+    def write_row(self, row):
+        if not self._header_written:
+            self._write_line(row.keys())
+        self.rows_written += 1
+        self._write_line(["" if value is None else encode_text_value(value) for value in row.values()])
+
+
+class TSVResultWriter(CSVResultWriter):
+    content_type = "text/tab-separated-values"
+    dialect = "excel-tab"
+
+
+# Arrow types of result columns by PostgreSQL type OID. Columns of other types, including JSON and JSONB, are written as
+# Arrow strings. NUMERIC columns are written as Arrow decimals (see get_arrow_type).
+_arrow_types_by_pg_type_oid = {
+    16: ("bool_",),
+    20: ("int64",),
+    21: ("int16",),
+    23: ("int32",),
+    700: ("float32",),
+    701: ("float64",),
+    1082: ("date32",),
+    1114: ("timestamp", "us"),
+    1184: ("timestamp", "us", "UTC")
+}
+
+
+_pg_numeric_type_oid = 1700
+_arrow_max_decimal_precision = 38
+
+
+def get_arrow_type(column):
+    """
+    Returns the Arrow type of a result column, given its cursor description. NUMERIC columns with a declared precision
+    that fits in a 128-bit decimal are written as decimals of that precision and scale, and other NUMERIC columns as
+    strings, so their values are not rounded.
+    """
+    import pyarrow as pa
+    if column.type_code == _pg_numeric_type_oid:
+        precision, scale = getattr(column, "precision", None), getattr(column, "scale", None)
+        if precision is not None and scale is not None and 0 < precision <= _arrow_max_decimal_precision:
+            return pa.decimal128(precision, scale)
+        return pa.string()
+    arrow_type = _arrow_types_by_pg_type_oid.get(column.type_code, ("string",))
+    return getattr(pa, arrow_type[0])(*arrow_type[1:])
+
+
+class _ByteSink:
+    """
+    Collects the output of pyarrow writers, so it can be passed on to ResultWriter.write() outside of pyarrow calls.
+    """
+    closed = False
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ColumnarResultWriter(ResultWriter):
+    """
+    Base class for writers that convert each page of rows into an Apache Arrow record batch. Column types are derived
+    from the cursor description. pyarrow is imported on first use, so it only costs load time when it is needed. It is
+    deployed in a Lambda layer, not in the app package (see the arrow-layer target in the Makefile).
+    """
+
+    def __init__(self, fh, **kwargs):
+        super().__init__(fh, **kwargs)
+        self._sink = _ByteSink()
+        self._schema = None
+
+    @property
+    def schema(self):
+        if self._schema is None:
+            import pyarrow as pa
+            self._schema = pa.schema([pa.field(column.name, get_arrow_type(column))
+                                      for column in self.cursor.description])
+        return self._schema
+
+    def record_batch(self, rows):
+        import pyarrow as pa
+        arrays = []
+        for i, field in enumerate(self.schema):
+            if field.type == pa.string():
+                values = [None if row[i] is None else str(row[i]) if isinstance(row[i], Decimal)
+                          else encode_text_value(row[i]) for row in rows]
+            else:
+                values = [row[i] for row in rows]
+            arrays.append(pa.array(values, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write_row(self, row):
+        self.write_rows([row])
+
+
+class ArrowResultWriter(ColumnarResultWriter):
+    """
+    Writes an Apache Arrow IPC stream with one record batch per page of rows.
+    """
+    content_type = "application/vnd.apache.arrow.stream"
+
+    def __init__(self, fh, **kwargs):
+        super().__init__(fh, **kwargs)
+        self._stream_writer = None
+
+    def _get_stream_writer(self):
+        if self._stream_writer is None:
+            import pyarrow as pa
+            self._stream_writer = pa.RecordBatchStreamWriter(self._sink, self.schema)
+        return self._stream_writer
+
+    def write_rows(self, rows):
+        rows = list(rows)
+        if rows:
+            self._get_stream_writer().write_batch(self.record_batch(rows))
+            self.rows_written += len(rows)
+            self.write(self._sink.take())
+
+    def close(self):
+        self._get_stream_writer().close()
+        self.write(self._sink.take())
+        super().close()
+
+
+class ParquetResultWriter(ColumnarResultWriter):
+    """
+    Writes an Apache Parquet file, with row groups of up to row_group_size rows. Parquet compresses column chunks
+    internally, so gzip and brotli compression are applied as Parquet codecs and not as a content encoding.
+    """
+    content_type = "application/vnd.apache.parquet"
+    compresses_internally = True
+    row_group_size = 64 * 1024
+    _parquet_codecs = {None: "snappy", "gzip": "gzip", "br": "brotli"}
+
+    def __init__(self, fh, content_encoding=None, **kwargs):
+        super().__init__(fh, **kwargs)
+        self.compression = self._parquet_codecs[content_encoding]
+        self._parquet_writer = None
+        self._batches = []  # type: list
+        self._buffered_rows = 0
+
+    def _flush_row_group(self):
+        import pyarrow as pa, pyarrow.parquet as pq
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self._sink, self.schema, compression=self.compression)
+        if self._batches:
+            self._parquet_writer.write_table(pa.Table.from_batches(self._batches, schema=self.schema))
+            self._batches, self._buffered_rows = [], 0
+        self.write(self._sink.take())
+
+    def write_rows(self, rows):
+        rows = list(rows)
+        if rows:
+            self._batches.append(self.record_batch(rows))
+            self._buffered_rows += len(rows)
+            self.rows_written += len(rows)
+            if self._buffered_rows >= self.row_group_size:
+                self._flush_row_group()
+
+    def close(self):
+        self._flush_row_group()
+        self._parquet_writer.close()
+        self.write(self._sink.take())
+        super().close()
+
+
+result_writers = {
+    "json": JSONResultWriter,
+    "compact_json": CompactJSONResultWriter,
+    "ndjson": NDJSONResultWriter,
+    "csv": CSVResultWriter,
+    "tsv": TSVResultWriter,
+    "arrow": ArrowResultWriter,
+    "parquet": ParquetResultWriter
+}
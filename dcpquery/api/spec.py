@@ -0,0 +1,112 @@
+"""
+Compiles the API spec into a JSON artifact that the API can start from without parsing the spec.
+
+Connexion renders the YAML API spec as a Jinja2 template, parses it, and registers a Flask route for each of its
+operations. `make package` does that work once at build time, and stores the rendered spec (validated, and with its
+refs resolved) and the resulting routes next to the spec, as dcpquery-api.json. An app started from the compiled spec
+registers its Chalice routes from the artifact, and builds the Connexion app from the stored spec, without validating
+or resolving it again, when it dispatches its first API request, so Lambda functions that only handle SQS messages
+never build it. The artifact records the hash of the spec it was compiled from, and is ignored if the spec has changed
+since. See scripts/compile_api_spec.py.
+"""
+import os, re, json, hashlib, logging, collections
+
+from connexion.apis.flask_api import FlaskApi
+from connexion.options import ConnexionOptions
+from connexion.resolver import Resolver
+from connexion.spec import OpenAPISpecification
+
+from .. import config
+
+logger = logging.getLogger(__name__)
+
+
+def get_compiled_spec_path(swagger_spec_path):
+    return os.path.splitext(swagger_spec_path)[0] + ".json"
+
+
+def get_spec_hash(swagger_spec_path):
+    with open(swagger_spec_path, "rb") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def get_routes(flask_app):
+    """
+    Returns the Chalice routes (with the methods each accepts) that proxy requests to the routes of a Flask app, and the
+    subset of routes that Flask serves with a trailing slash.
+    """
+    routes, trailing_slash_routes = collections.defaultdict(set), []
+    for rule in flask_app.url_map.iter_rules():
+        route = re.sub(r"<(.+?)(:.+?)?>", r"{\1}", rule.rule)
+        if route.endswith("/"):
+            trailing_slash_routes.append(route.rstrip("/"))
+        routes[route.rstrip("/")] |= rule.methods
+    return {route: sorted(methods - {"OPTIONS"}) for route, methods in routes.items()}, trailing_slash_routes
+
+
+def compile_spec(swagger_spec_path, app_name):
+    from . import ChaliceWithConnexion
+    app = ChaliceWithConnexion(swagger_spec_path=swagger_spec_path, app_name=app_name)
+    routes, trailing_slash_routes = get_routes(app.connexion_app.app)
+    return {
+        "source_sha256": get_spec_hash(swagger_spec_path),
+        "spec": {
+            "raw": app.connexion_api.specification.raw,
+            "resolved": dict(app.connexion_api.specification.items())
+        },
+        "routes": routes,
+        "trailing_slash_routes": trailing_slash_routes
+    }
+
+
+def load_compiled_spec(swagger_spec_path):
+    """
+    Returns the compiled form of the API spec, or None if it has not been compiled or is out of date.
+    """
+    compiled_spec_path = get_compiled_spec_path(swagger_spec_path)
+    if not config.api_compiled_spec or not os.path.exists(compiled_spec_path):
+        return None
+    with open(compiled_spec_path) as fh:
+        compiled_spec = json.load(fh)
+    if compiled_spec["source_sha256"] != get_spec_hash(swagger_spec_path):
+        logger.warning("Ignoring %s, which was compiled from a different version of %s", compiled_spec_path,
+                       swagger_spec_path)
+        return None
+    return compiled_spec
+
+
+class CompiledSpecification(OpenAPISpecification):
+    """
+    An API spec loaded from its compiled form, which was validated and had its refs resolved by compile_spec.
+    """
+
+    def __init__(self, compiled_spec):
+        self._raw_spec, self._spec = compiled_spec["raw"], compiled_spec["resolved"]
+
+
+class CompiledSpecFlaskApi(FlaskApi):
+    """
+    A Connexion Flask API created from the "spec" of a compiled spec. The Connexion 2.3 AbstractAPI constructor always
+    loads its spec with Specification.load, which validates the spec and resolves its refs, so this constructor sets up
+    the API the same way from a CompiledSpecification instead. test_spec checks that it keeps the upstream constructor's
+    signature and sets the same attributes, so a Connexion upgrade that changes the constructor fails the tests.
+    """
+
+    def __init__(self, specification, base_path=None, arguments=None, validate_responses=False,
+                 strict_validation=False, resolver=None, auth_all_paths=False, debug=False, resolver_error_handler=None,
+                 validator_map=None, pythonic_params=False, pass_context_arg_name=None, options=None):
+        self.debug, self.validator_map, self.resolver_error_handler = debug, validator_map, resolver_error_handler
+        self.specification = CompiledSpecification(specification)
+        self.options = ConnexionOptions(options, oas_version=self.specification.version)
+        self._set_base_path(base_path)
+        self.resolver = resolver or Resolver()
+        self.validate_responses, self.strict_validation = validate_responses, strict_validation
+        self.pythonic_params, self.pass_context_arg_name = pythonic_params, pass_context_arg_name
+        if self.options.openapi_spec_available:
+            self.add_openapi_json()
+            self.add_openapi_yaml()
+        if self.options.openapi_console_ui_available:
+            self.add_swagger_ui()
+        self.add_paths()
+        if auth_all_paths:
+            self.add_auth_on_not_found(self.specification.security, self.specification.security_definitions)
@@ -0,0 +1,119 @@
+"""
+Write-only file-like objects for storing async query results.
+
+Query result writers stream encoded rows into these objects while the database cursor is being read, so the memory
+needed to store a result is bounded by the upload part size rather than by the size of the result.
+"""
+import os
+
+from dcplib.aws import clients
+
+from .. import config
+
+
+class ResultUpload:
+    def __init__(self):
+        self.size = 0
+        self.location = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        elif self.location is None:
+            self.close()
+
+    def write(self, data):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def abort(self):
+        raise NotImplementedError()
+
+
+class S3MultipartUpload(ResultUpload):
+    """
+    Uploads its contents to S3 in multipart chunks as they are written, holding at most one part in memory. Contents
+    that fit in a single part are uploaded with a single PutObject request instead.
+    """
+
+    def __init__(self, bucket, key, part_size=None, **put_object_args):
+        super().__init__()
+        self.bucket, self.key = bucket, key
+        self.part_size = part_size or config.s3_multipart_upload_part_size
+        self.put_object_args = put_object_args
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []  # type: list
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = clients.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 **self.put_object_args)["UploadId"]
+        part_number = len(self._parts) + 1
+        res = clients.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                     PartNumber=part_number, Body=bytes(body))
+        self._parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self._upload_id is None:
+            clients.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.put_object_args)
+        else:
+            if self._buffer:
+                self._upload_part(self._buffer)
+            clients.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                 MultipartUpload={"Parts": self._parts})
+        self._buffer = bytearray()
+        self.location = {"Bucket": self.bucket, "Key": self.key}
+        return self.location
+
+    def abort(self):
+        if self._upload_id is not None:
+            clients.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+
+
+class LocalFileUpload(ResultUpload):
+    """
+    Filesystem-backed stand-in for S3MultipartUpload, used when config.local_job_result_dir is set.
+    """
+
+    def __init__(self, path, **put_object_args):
+        super().__init__()
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fh = open(path + ".partial", "wb")
+
+    def write(self, data):
+        self.size += len(data)
+        return self._fh.write(data)
+
+    def close(self):
+        self._fh.close()
+        os.rename(self._fh.name, self.path)
+        self.location = {"Path": self.path}
+        return self.location
+
+    def abort(self):
+        self._fh.close()
+        os.remove(self._fh.name)
+
+
+def open_job_result_upload(job_id, **put_object_args):
+    key = f"job_result/{job_id}"
+    if config.local_job_result_dir is not None:
+        return LocalFileUpload(os.path.join(config.local_job_result_dir, key), **put_object_args)
+    return S3MultipartUpload(config.s3_bucket_name, key, **put_object_args)
@@ -1,12 +1,14 @@
 """
 This module provides a SQLAlchemy-based database schema for the DCP Query Service.
 """
-import logging
+import re, json, time, hashlib, logging, functools, threading, collections, typing
+from contextlib import contextmanager
 
+import psycopg2
 from sqlalchemy import (exc as sqlalchemy_exceptions)
 
 from .. import config
-from ..exceptions import DCPQueryError, QueryTimeoutError
+from ..exceptions import DCPQueryError, QueryTimeoutError, QueryCancelledError
 
 logger = logging.getLogger(__name__)
 
@@ -45,23 +47,214 @@ def migrate_db():
     alembic.command.upgrade(config.alembic_config, "head")
 
 
-def run_query(query, params, rows_per_page=100):
+# Server-side (named) cursors can only be declared for a single SELECT, VALUES or TABLE statement.
+_streamable_query_pattern = re.compile(r"^\s*(select|with|values|table)\b[^;]*;?\s*$", re.IGNORECASE)
+
+
+def can_stream_results(query):
+    return _streamable_query_pattern.match(query) is not None
+
+
+@contextmanager
+def translate_db_errors():
+    # Errors raised while a server-side cursor buffers its first page of rows are not wrapped by SQLAlchemy.
     try:
-        cursor = config.db.execute(query, params)
-        while True:
-            rows = cursor.fetchmany(size=rows_per_page)
-            for row in rows:
-                yield row
-            if not rows:
-                break
-    except (sqlalchemy_exceptions.InternalError, sqlalchemy_exceptions.ProgrammingError) as e:
-        raise DCPQueryError(title=e.orig.pgerror, detail={"pgcode": e.orig.pgcode})
-    except sqlalchemy_exceptions.OperationalError as e:
+        yield
+    except (sqlalchemy_exceptions.InternalError, sqlalchemy_exceptions.ProgrammingError,
+            psycopg2.InternalError, psycopg2.ProgrammingError) as e:
+        orig = getattr(e, "orig", e)
+        raise DCPQueryError(title=orig.pgerror, detail={"pgcode": orig.pgcode})
+    except (sqlalchemy_exceptions.OperationalError, psycopg2.OperationalError) as e:
+        orig = getattr(e, "orig", e)
         if "canceling statement due to statement timeout" in str(e):
-            raise QueryTimeoutError(title=e.orig.pgerror, detail={"pgcode": e.orig.pgcode})
+            raise QueryTimeoutError(title=orig.pgerror, detail={"pgcode": orig.pgcode})
+        elif "canceling statement due to user request" in str(e):
+            raise QueryCancelledError(title=orig.pgerror, detail={"pgcode": orig.pgcode})
         else:
             raise
 
 
+class QueryCursor:
+    """
+    Executes a query on a dedicated database connection and iterates over the result, one page of rows at a time.
+
+    When stream_results is set, the query is executed with a server-side (named) cursor, so the database sends rows to
+    the client one page at a time instead of transferring the whole result set when the query is executed. The
+    connection is released when the result is exhausted or the cursor is closed; an open cursor can be handed off to
+    another consumer, which resumes iteration where the previous one stopped.
+
+    If given, application_name is set for the duration of the query, identifying it in pg_stat_activity, and on_connect
+    is called with the cursor before the query is executed, so the caller can arrange for it to be cancelled (see
+    cancel).
+    """
+
+    def __init__(self, query, params, rows_per_page=None, stream_results=None, timeout_seconds=None,
+                 application_name=None, on_connect=None):
+        self.query, self.params = query, params
+        self.rows_per_page = rows_per_page or config.db_fetch_size
+        if stream_results is None:
+            stream_results = config.db_stream_results and can_stream_results(query)
+        self.stream_results = stream_results
+        self.timeout_seconds = timeout_seconds or config.db_statement_timeout_seconds
+        self.start_time = time.time()
+        self._page: typing.Deque = collections.deque()
+        self.description = None
+        self._cancel_lock = threading.Lock()
+        self._connection = config.db.connect()
+        try:
+            # The transaction is rolled back when the connection is returned to the pool, which also resets settings
+            # made with SET LOCAL
+            self._connection.begin()
+            config.set_db_transaction_timeout(self._connection, self.timeout_seconds)
+            if application_name is not None:
+                self._connection.execute("SELECT set_config('application_name', %(name)s, true)",
+                                         dict(name=application_name))
+            if on_connect is not None:
+                on_connect(self)
+            with translate_db_errors():
+                connection = self._connection
+                if stream_results:
+                    connection = connection.execution_options(stream_results=True, max_row_buffer=self.rows_per_page)
+                self._result = connection.execute(query, params)
+            self._save_description()
+        except Exception:
+            self.close()
+            raise
+
+    def keys(self):
+        return self._result.keys()
+
+    def _save_description(self):
+        # A server-side cursor only has a DB-API description once the first page of rows has been fetched.
+        if self.description is None and self._result.cursor is not None:
+            self.description = self._result.cursor.description
+
+    def fetch_page(self):
+        if self._connection is None:
+            return []
+        try:
+            # With a server-side cursor, the statement timeout only applies to each individual fetch.
+            if time.time() - self.start_time > self.timeout_seconds:
+                raise QueryTimeoutError(title="Query exceeded time limit", detail=str(self.timeout_seconds))
+            with translate_db_errors():
+                rows = self._result.fetchmany(self.rows_per_page)
+            self._save_description()
+        except Exception:
+            self.close()
+            raise
+        if not rows:
+            self.close()
+        return rows
+
+    def pages(self):
+        if self._page:
+            yield list(self._page)
+            self._page.clear()
+        while True:
+            rows = self.fetch_page()
+            if not rows:
+                break
+            yield rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Rows are buffered on the cursor, so an interrupted iteration can be resumed without losing rows.
+        if not self._page:
+            self._page.extend(self.fetch_page())
+            if not self._page:
+                raise StopIteration()
+        return self._page.popleft()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def cancel(self):
+        """
+        Cancels the statement running on the cursor's connection, if the connection is still open. This can be called
+        from another thread. The cancel request is sent to the database server that the connection is open to, and the
+        connection is not released while it is sent, so it cannot cancel a query on another replica or connection.
+        """
+        with self._cancel_lock:
+            if self._connection is not None:
+                self._connection.connection.cancel()
+
+    def close(self):
+        with self._cancel_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def query_fingerprint(query, params, *args):
+    """
+    Returns a hash of the query text, its parameters, and any other arguments given that affect its result. The query
+    text is hashed exactly as given: collapsing whitespace would also change string literals and comments, so that
+    queries with different results could share a fingerprint.
+    """
+    fingerprint_doc = [query, params] + list(args)
+    return hashlib.sha256(json.dumps(fingerprint_doc, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=1024)
+def _explain_query(query, params_json, data_generation):
+    # Errors are raised rather than returned, so that lru_cache does not keep them
+    with translate_db_errors():
+        plan = config.db.execute("EXPLAIN (FORMAT JSON) " + query, json.loads(params_json)).scalar()
+    return plan[0]["Plan"]["Total Cost"], plan[0]["Plan"]["Plan Rows"]
+
+
+def estimate_query_cost(query, params):
+    """
+    Returns the query planner's estimated total cost and row count for a query, or None if the query cannot be
+    explained. Estimates are cached per query text, parameters and data generation, since the planner's statistics
+    change with the data; failures are not cached.
+    """
+    if not can_stream_results(query):
+        return None
+    try:
+        return _explain_query(query, json.dumps(params, sort_keys=True), get_data_generation())
+    except DCPQueryError as e:
+        logger.debug("Unable to explain query %s: %s", query, e)
+        return None
+
+
+def run_query(query, params, rows_per_page=None, stream_results=None, timeout_seconds=None, application_name=None,
+              on_connect=None):
+    return QueryCursor(query, params, rows_per_page=rows_per_page, stream_results=stream_results,
+                       timeout_seconds=timeout_seconds, application_name=application_name, on_connect=on_connect)
+
+
+_data_generation = (None, 0.0)
+
+
+def get_data_generation():
+    """
+    Returns the current data generation number. The ETL increments it whenever it changes the data, so results
+    computed under one generation can be reused until the next one starts. The number is read from the database at most
+    every config.data_generation_max_age_seconds.
+    """
+    global _data_generation
+    data_generation, read_time = _data_generation
+    if data_generation is None or time.time() - read_time > config.data_generation_max_age_seconds:
+        read_time = time.time()
+        with translate_db_errors():
+            data_generation = config.db.execute("SELECT last_value FROM data_generation").scalar()
+        _data_generation = (data_generation, read_time)
+    return data_generation
+
+
+def bump_data_generation():
+    # Called after the ETL commits its changes, so a result is never cached under a generation that it predates.
+    global _data_generation
+    data_generation = config.db.execute("SELECT nextval('data_generation')").scalar()
+    _data_generation = (data_generation, time.time())
+    return data_generation
+
+
 def commit_to_db(arg):
     config.db_session.commit()
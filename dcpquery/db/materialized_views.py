@@ -45,8 +45,8 @@ def create_dcp_schema_type_materialized_views(matviews):
 
 
 def create_materialized_view_tables():
-    matviews = [x[0] for x in config.db_session.execute("SELECT matviewname FROM pg_catalog.pg_matviews;").fetchall()]
     config.reset_db_timeout_seconds(880)
+    matviews = [x[0] for x in config.db_session.execute("SELECT matviewname FROM pg_catalog.pg_matviews;").fetchall()]
     update_bundles_materialized_view()
     update_files_materialized_view()
     create_dcp_schema_type_materialized_views(matviews)
@@ -1,4 +1,5 @@
 from dcpquery import config
+from dcpquery.db import bump_data_generation
 from dcpquery.db.models import Bundle, BundleFileLink, File, ProjectFileLink, Project
 from dcpquery.etl import etl_one_bundle, logger
 
@@ -8,6 +9,7 @@ def drop_one_bundle(bundle_uuid, bundle_version):
     delete_files_and_bundle_file_links_for_bundle_deletion(bundle_fqid)
     Bundle.delete_bundles([bundle_fqid])
     config.db_session.commit()
+    bump_data_generation()
 
 
 def delete_files_and_bundle_file_links_for_bundle_deletion(bundle_fqid):
@@ -41,8 +43,9 @@ def delete_projects_and_project_file_links_for_file_deletion(file_fqids):
 
 
 def process_bundle_event(dss_event):
-    config.readonly_db = False
-    config.reset_db_session()
+    if config.readonly_db:
+        config.readonly_db = False
+        config.reset_db_session()
     logger.info(f"Processing DSS event: {dss_event}")
     if dss_event["event_type"] == "CREATE":
         logger.info(f"Processing DSS CREATE event: {dss_event}")
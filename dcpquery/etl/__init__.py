@@ -2,6 +2,7 @@ import os, tempfile, logging
 
 from dcplib.etl import DSSExtractor
 
+from dcpquery.db import bump_data_generation
 from dcpquery.db.materialized_views import create_materialized_view_tables
 from dcpquery.etl.load import BundleLoader
 from dcpquery.etl.transform import transform_bundle
@@ -46,6 +47,7 @@ def update_process_join_table():
 def dcpquery_etl_finalizer(extractor):
     create_materialized_view_tables()
     update_process_join_table()
+    bump_data_generation()
 
 
 def etl_one_bundle(bundle_uuid, bundle_version):
@@ -62,3 +64,4 @@ def etl_one_bundle(bundle_uuid, bundle_version):
                           bundle_manifest_path=bundle_manifest_path, extractor=extractor)
     BundleLoader().load_bundle(extractor=extractor, transformer=transform_bundle, bundle=tb)
     config.db_session.commit()
+    bump_data_generation()
@@ -17,5 +17,9 @@ class QuerySizeError(DatabaseError):
     pass
 
 
+class QueryCancelledError(DatabaseError):
+    pass
+
+
 class DCPFileNotFoundError(ProblemException):
     pass
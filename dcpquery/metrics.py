@@ -0,0 +1,32 @@
+"""
+Publishing of service metrics to CloudWatch.
+
+Metrics are written to the Lambda log in the CloudWatch embedded metric format, from which CloudWatch extracts them
+asynchronously, so publishing a metric does not make an API call on the request path.
+"""
+import json, time, logging
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def put_metric(name, value, unit="None", **dimensions):
+    """
+    Publishes a metric value in the namespace of the app, with the given dimensions (e.g. Route="GET /bundles").
+    """
+    if config.local_mode:
+        logger.debug("Metric %s=%s %s %s", name, value, unit, dimensions)
+        return
+    doc = dict(dimensions, **{
+        name: value,
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": config.app_name,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit}]
+            }]
+        }
+    })
+    print(json.dumps(doc), flush=True)
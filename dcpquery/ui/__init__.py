@@ -0,0 +1,36 @@
+"""
+The service's web UI: a single page that presents the canned queries in queries/, rendered from index.html.
+
+The page only changes when the service is deployed, so it is rendered once per container for each combination of the
+environment values it displays, and served with a strong ETag derived from its content.
+"""
+import os, glob, hashlib, functools
+
+ui_assets_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Environment variables that index.html displays
+page_env_vars = ("API_DOMAIN_NAME", "APP_NAME", "VERSION")
+
+
+def load_queries():
+    queries = []
+    for query_path in sorted(glob.glob(os.path.join(ui_assets_dir, "queries", "*"))):
+        with open(query_path) as fh:
+            queries.append(fh.read())
+    return queries
+
+
+@functools.lru_cache(maxsize=8)
+def render_page(env_items):
+    import jinja2
+    with open(os.path.join(ui_assets_dir, "index.html")) as fh:
+        template = jinja2.Template(fh.read())
+    body = template.render(env=dict(env_items), queries=load_queries()).encode()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def get_page():
+    """
+    Returns the rendered UI page and its ETag.
+    """
+    return render_page(tuple((name, os.environ[name]) for name in page_env_vars if name in os.environ))
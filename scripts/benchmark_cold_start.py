@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Measures the cold start time of each kind of Lambda function in the app: the time a fresh Python process takes to
+import app.py and load everything its first invocation needs, excluding the work done by the invocation itself.
+
+Each measurement runs in a new interpreter that does not write .pyc files (Lambda packages are built without them),
+and the runs for different handlers are interleaved so that they share the same system conditions. Results are
+printed as JSON, so they can be stored with each release and compared, e.g.:
+
+    scripts/benchmark_cold_start.py --app-dir dist/deployment --runs 50 > cold_start-$(git describe --tags).json
+"""
+import os, sys, json, time, argparse, subprocess, statistics
+
+# Statements that load what the first invocation of each kind of handler needs, after app.py has been imported
+handlers = {
+    "api": "app.app.load_connexion_app()",
+    "bundle_event_handler": "import dcpquery.dss_subscription_event_handling",
+    "async_query_handler": "import dcpquery.api.query_jobs",
+}
+
+probe = """
+import time
+start_time = time.perf_counter()
+import app
+import_time = time.perf_counter()
+{load}
+print(import_time - start_time, time.perf_counter() - start_time)
+"""
+
+
+def measure(handler, app_dir):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1", PYTHONPATH=app_dir)
+    output = subprocess.check_output([sys.executable, "-B", "-c", probe.format(load=handlers[handler])], cwd=app_dir,
+                                     env=env, stderr=subprocess.DEVNULL)
+    return [float(t) * 1000 for t in output.decode().split()]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(times):
+    return {
+        "min": round(min(times), 1),
+        "p50": round(statistics.median(times), 1),
+        "p99": round(percentile(times, 99), 1),
+        "max": round(max(times), 1)
+    }
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--app-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+                    help="Directory containing app.py (e.g. dist/deployment to benchmark the packaged app)")
+parser.add_argument("--runs", type=int, default=20)
+parser.add_argument("--handlers", nargs="+", choices=handlers.keys(), default=list(handlers))
+args = parser.parse_args()
+
+app_dir = os.path.abspath(args.app_dir)
+results = {handler: {"import_ms": [], "cold_start_ms": []} for handler in args.handlers}
+for run in range(args.runs):
+    for handler in args.handlers:
+        import_ms, cold_start_ms = measure(handler, app_dir)
+        results[handler]["import_ms"].append(import_ms)
+        results[handler]["cold_start_ms"].append(cold_start_ms)
+
+print(json.dumps({
+    "python": sys.version.split()[0],
+    "runs": args.runs,
+    "compiled_spec": os.path.exists(os.path.join(app_dir, os.environ["APP_NAME"] + "-api.json")),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "handlers": {handler: {key: summarize(times) for key, times in result.items()}
+                 for handler, result in results.items()}
+}, indent=2))
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+"""
+Compiles the API spec into the artifact that the API starts from in production (see dcpquery/api/spec.py). This script
+is run by `make package`.
+"""
+import os, sys, json, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dcpquery import config  # noqa
+from dcpquery.api.spec import compile_spec, get_compiled_spec_path  # noqa
+
+config.configure_logging()
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("swagger_spec_path")
+parser.add_argument("--output", help="Path to write the compiled spec to (default: next to the spec)")
+parser.add_argument("--app-name", default=os.environ["APP_NAME"])
+args = parser.parse_args()
+
+with open(args.output or get_compiled_spec_path(args.swagger_spec_path), "w") as fh:
+    json.dump(compile_spec(os.path.abspath(args.swagger_spec_path), args.app_name), fh)
@@ -7,15 +7,42 @@ resource "aws_sqs_queue" "bundle_events" {
   })
 }
 
-resource "aws_sqs_queue" "async_queries" {
-  name = "${var.ASYNC_QUERIES_QUEUE_NAME}"
+resource "aws_sqs_queue" "async_queries_interactive" {
+  name = "${var.ASYNC_QUERIES_QUEUE_NAME}-interactive.fifo"
+  fifo_queue = true
   visibility_timeout_seconds = 900
   redrive_policy = jsonencode({
-    "deadLetterTargetArn" = "${aws_sqs_queue.dlq.arn}",
+    "deadLetterTargetArn" = "${aws_sqs_queue.async_queries_dlq.arn}",
+    "maxReceiveCount" = 5
+  })
+}
+
+resource "aws_sqs_queue" "async_queries_bulk" {
+  name = "${var.ASYNC_QUERIES_QUEUE_NAME}-bulk.fifo"
+  fifo_queue = true
+  visibility_timeout_seconds = 900
+  redrive_policy = jsonencode({
+    "deadLetterTargetArn" = "${aws_sqs_queue.async_queries_dlq.arn}",
+    "maxReceiveCount" = 5
+  })
+}
+
+resource "aws_sqs_queue" "async_queries_internal" {
+  name = "${var.ASYNC_QUERIES_QUEUE_NAME}-internal.fifo"
+  fifo_queue = true
+  visibility_timeout_seconds = 900
+  redrive_policy = jsonencode({
+    "deadLetterTargetArn" = "${aws_sqs_queue.async_queries_dlq.arn}",
     "maxReceiveCount" = 5
   })
 }
 
+# The dead-letter queue of a FIFO queue must also be a FIFO queue
+resource "aws_sqs_queue" "async_queries_dlq" {
+  name = "${var.ASYNC_QUERIES_QUEUE_NAME}-dlq.fifo"
+  fifo_queue = true
+}
+
 resource "aws_sqs_queue" "dlq" {
   name = "${var.APP_NAME}-${var.STAGE}-dlq"
 }
@@ -27,10 +54,24 @@ data "template_file" "bundle_events_queue_policy_doc" {
   }
 }
 
-data "template_file" "async_queries_queue_policy_doc" {
+data "template_file" "async_queries_interactive_queue_policy_doc" {
+  template = "${file("${path.module}/../iam/policy-templates/sqs_queue.json")}"
+  vars = {
+    queue_arn = "${aws_sqs_queue.async_queries_interactive.arn}"
+  }
+}
+
+data "template_file" "async_queries_bulk_queue_policy_doc" {
   template = "${file("${path.module}/../iam/policy-templates/sqs_queue.json")}"
   vars = {
-    queue_arn = "${aws_sqs_queue.async_queries.arn}"
+    queue_arn = "${aws_sqs_queue.async_queries_bulk.arn}"
+  }
+}
+
+data "template_file" "async_queries_internal_queue_policy_doc" {
+  template = "${file("${path.module}/../iam/policy-templates/sqs_queue.json")}"
+  vars = {
+    queue_arn = "${aws_sqs_queue.async_queries_internal.arn}"
   }
 }
 
@@ -39,9 +80,19 @@ resource "aws_sqs_queue_policy" "bundle_events_policy" {
   policy = "${data.template_file.bundle_events_queue_policy_doc.rendered}"
 }
 
-resource "aws_sqs_queue_policy" "async_queries_policy" {
-  queue_url = "${aws_sqs_queue.async_queries.id}"
-  policy = "${data.template_file.async_queries_queue_policy_doc.rendered}"
+resource "aws_sqs_queue_policy" "async_queries_interactive_policy" {
+  queue_url = "${aws_sqs_queue.async_queries_interactive.id}"
+  policy = "${data.template_file.async_queries_interactive_queue_policy_doc.rendered}"
+}
+
+resource "aws_sqs_queue_policy" "async_queries_bulk_policy" {
+  queue_url = "${aws_sqs_queue.async_queries_bulk.id}"
+  policy = "${data.template_file.async_queries_bulk_queue_policy_doc.rendered}"
+}
+
+resource "aws_sqs_queue_policy" "async_queries_internal_policy" {
+  queue_url = "${aws_sqs_queue.async_queries_internal.id}"
+  policy = "${data.template_file.async_queries_internal_queue_policy_doc.rendered}"
 }
 
 data "aws_acm_certificate" "api_cert" {
@@ -86,6 +137,16 @@ resource "aws_s3_bucket" "query_service_bucket" {
     expiration {
       days = 30
     }
+    abort_incomplete_multipart_upload_days = 1
+  }
+
+  lifecycle_rule {
+    id = "query_result_cache"
+    enabled = true
+    prefix = "query_result_cache/"
+    expiration {
+      days = 7
+    }
   }
 
   lifecycle_rule {
@@ -96,12 +157,34 @@ resource "aws_s3_bucket" "query_service_bucket" {
       days = 30
     }
   }
+
+  lifecycle_rule {
+    id = "job_cancellation_docs"
+    enabled = true
+    prefix = "job_cancellation/"
+    expiration {
+      days = 30
+    }
+  }
+
+  lifecycle_rule {
+    id = "job_index_docs"
+    enabled = true
+    prefix = "job_index/"
+    expiration {
+      days = 30
+    }
+  }
 }
 
 resource "aws_secretsmanager_secret" "webhook_auth_config" {
   name = "${var.APP_NAME}/${var.STAGE}/webhook-auth-config"
 }
 
+resource "aws_secretsmanager_secret" "job_callback_auth_config" {
+  name = "${var.APP_NAME}/${var.STAGE}/job-callback-auth-config"
+}
+
 resource "aws_secretsmanager_secret" "gcp_credentials" {
   name = "${var.APP_NAME}/${var.STAGE}/gcp-credentials.json"
 }
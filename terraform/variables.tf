@@ -0,0 +1,12 @@
+variable APP_NAME { default = "dcpquery" }
+variable STAGE { default = "dev" }
+variable OWNER { default = "query-service-team@data.humancellatlas.org" }
+variable BUNDLE_EVENTS_QUEUE_NAME { default = "dcpquery-dev-bundle-events" }
+variable ASYNC_QUERIES_QUEUE_NAME { default = "dcpquery-dev-async-queries" }
+variable WEBHOOK_SECRET_NAME { default = "dcpquery/dev/webhook-auth-config" }
+variable API_DOMAIN_NAME { default = "query.dev.data.humancellatlas.org" }
+variable API_DNS_ZONE { default = "dev.data.humancellatlas.org." }
+variable AWS_ACCOUNT_ID { default = "" }
+variable SERVICE_S3_BUCKET { default = "org-humancellatlas-dcpquery-dev" }
+variable DSS_HOST { default = "dss.staging.data.humancellatlas.org" }
+variable DCPQUERY_DEBUG { default = "1" }
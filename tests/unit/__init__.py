@@ -61,3 +61,15 @@ class TestChaliceApp(unittest.TestCase, DCPAssertMixin):
         res = self.app.get('/')
         res.raise_for_status()
         self.assertEqual(res.status_code, requests.codes.ok)
+
+    def test_root_route_etag(self):
+        res = self.app.get('/')
+        self.assertEqual(res.headers["Content-Type"], "text/html")
+        self.assertIn("max-age", res.headers["Cache-Control"])
+        etag = res.headers["ETag"]
+        self.assertEqual(self.app.get('/').headers["ETag"], etag)
+        res = self.app.get('/', headers={"if-none-match": etag})
+        self.assertEqual(res.status_code, requests.codes.not_modified)
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(res.content, b"")
+        self.assertEqual(self.app.get('/', headers={"if-none-match": '"stale"'}).status_code, requests.codes.ok)
@@ -0,0 +1,43 @@
+import os, sys, gzip, unittest
+from unittest.mock import patch
+
+import brotli
+
+from dcpquery import config
+from dcpquery.api.compression import choose_content_encoding, compress_body, compressed_bodies, cache_compressed_body
+
+
+class TestCompression(unittest.TestCase):
+    def test_choose_content_encoding(self):
+        self.assertEqual(choose_content_encoding({"br", "gzip"}, 100), (None, None))
+        self.assertEqual(choose_content_encoding({"br", "gzip"}, 100 * 1024), ("br", 5))
+        self.assertEqual(choose_content_encoding({"gzip"}, 100 * 1024), ("gzip", 6))
+        self.assertEqual(choose_content_encoding({"br", "gzip"}, 2 * 1024 * 1024), ("br", 3))
+        self.assertEqual(choose_content_encoding({"br", "gzip"}, 64 * 1024 * 1024), ("br", 1))
+        self.assertEqual(choose_content_encoding({"br", "gzip"}, None), ("br", 1))
+        self.assertEqual(choose_content_encoding({"identity"}, 100 * 1024), (None, None))
+        with patch.object(config, "response_compression_min_size", 0):
+            self.assertEqual(choose_content_encoding({"gzip"}, 100), ("gzip", 6))
+
+    def test_compress_body(self):
+        chunks = [b"abc" * 1000, b"def" * 1000]
+        body, cached = compress_body(iter(chunks), "gzip", 1)
+        self.assertEqual(gzip.decompress(body), b"".join(chunks))
+        self.assertFalse(cached)
+        compressed_bodies.clear()
+        body, cached = compress_body(chunks, "br", 5, cacheable=True)
+        self.assertEqual(brotli.decompress(body), b"".join(chunks))
+        self.assertFalse(cached)
+        self.assertEqual(compress_body(chunks, "br", 5, cacheable=True), (body, True))
+        self.assertEqual(compress_body(chunks, "br", 3, cacheable=True), (body, True))
+        self.assertFalse(compress_body(chunks, "gzip", 5, cacheable=True)[1])
+        compressed_bodies.clear()
+        cache_compressed_body(b"".join(chunks), "br", body)
+        self.assertEqual(compress_body(chunks, "br", 5, precompressed=True), (body, True))
+        self.assertEqual(compressed_bodies.size, 0)
+        self.assertEqual(compress_body(chunks, "br", 5, precompressed=True), (body, False))
+        self.assertEqual(compressed_bodies.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,18 @@
-import os, sys, json, unittest
+import os, sys, io, json, gzip, time, datetime, tempfile, ipaddress, threading, unittest
 
-from unittest.mock import patch
+from unittest.mock import patch, ANY, MagicMock, PropertyMock
+
+import requests
+from requests_http_signature import HTTPSignatureAuth
 
 from dcpquery import config
-from dcpquery.api.query_job import create_async_query_job
-from dcpquery.api.query_jobs import process_async_query
+from dcpquery.api.query_job import create_async_query_job, get_caller, get_message_group_id
+from dcpquery.api.query_jobs import (process_async_query, process_async_queries, find_job_id, get, get_results,
+                                     get_retry_after, check_callback_url, send_job_callback, post_to_address,
+                                     delete_sqs_messages)
+from dcpquery.api.uploads import open_job_result_upload
+from dcpquery.db import bump_data_generation
+from dcpquery.exceptions import DCPQueryError
 
 
 class TestCreateAsyncQuery(unittest.TestCase):
@@ -31,11 +39,195 @@ class TestCreateAsyncQuery(unittest.TestCase):
         set_job_status.assert_called_with(
             self.job_id,
             result_location={'Bucket': config.s3_bucket_name, 'Key': f'job_result/{self.job_id}'},
-            status="done"
+            status="done",
+            result_row_count=10,
+            result_size=ANY,
+            result_chunks=ANY,
+            lane="interactive"
         )
 
+    @patch("dcpquery.api.query_jobs.get_job_status", return_value=None)
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    def test_process_async_query_streams_result_to_local_dir(self, set_job_status, get_job_status):
+        config.db_statement_timeout_seconds = 880
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "async_query_fetch_size", 3):
+            process_async_query(self.mock_event_record)
+            result_path = os.path.join(td, "job_result", self.job_id)
+            set_job_status.assert_called_with(self.job_id, status="done", result_location={"Path": result_path},
+                                              result_row_count=10, result_size=os.path.getsize(result_path),
+                                              result_chunks=ANY, lane="interactive")
+            with open(result_path) as fh:
+                job_result = json.load(fh)
+        self.assertEqual(job_result["job_id"], self.job_id)
+        self.assertEqual(job_result["query"], self.query)
+        self.assertEqual(len(job_result["result"]), 10)
+
+    def test_process_async_query_writes_result_chunks(self):
+        config.db_statement_timeout_seconds = 880
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "job_store_url", os.path.join(td, "job_store")), \
+                patch.object(config, "async_query_fetch_size", 3), patch.object(config, "job_result_chunk_rows", 4):
+            process_async_query(self.mock_event_record)
+            job_status = get(self.job_id)
+            self.assertEqual(job_status["status"], "done")
+            self.assertEqual(job_status["result_row_count"], 10)
+            self.assertEqual(job_status["result_chunk_count"], 3)
+            results = get_results(self.job_id)
+            self.assertEqual([c["row_offset"] for c in results["chunks"]], [0, 4, 8])
+            self.assertEqual([c["row_count"] for c in results["chunks"]], [4, 4, 2])
+            self.assertEqual(sum(c["size"] for c in results["chunks"]), job_status["result_size"])
+            self.assertEqual(results["chunks"][2]["byte_offset"],
+                             job_status["result_size"] - results["chunks"][2]["size"])
+            rows = []
+            for chunk in results["chunks"]:
+                with open(chunk["url"][len("file://"):]) as fh:
+                    rows.extend(json.load(fh)["result"])
+            self.assertEqual([row["fqid"] for row in rows],
+                             [row["fqid"] for row in config.db.execute(self.query, self.params)])
+            self.assertEqual([c["row_offset"] for c in get_results(self.job_id, offset=5, limit=2)["chunks"]], [4])
+            self.assertEqual([c["row_offset"] for c in get_results(self.job_id, offset=3, limit=2)["chunks"]], [0, 4])
+            self.assertEqual(get_results(self.job_id, offset=10)["chunks"], [])
+            with patch.object(config, "app"):
+                res = get(self.job_id, redirect_when_done=True)
+            self.assertEqual(res.headers["Location"], f"{self.job_id}/results")
+
+    @patch("dcpquery.api.query_jobs.get_job_status", return_value=None)
+    @patch("dcpquery.api.query_jobs.open_job_result_upload", wraps=open_job_result_upload)
     @patch("dcpquery.api.query_jobs.set_job_status")
-    def test_process_async_query_with_invalid_query(self, set_job_status):
+    def test_process_async_query_output_format(self, set_job_status, open_job_result_upload, get_job_status):
+        config.db_statement_timeout_seconds = 880
+        body = json.dumps(dict(query=self.query, params=self.params, output_format="csv", compression="gzip"))
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td):
+            process_async_query(dict(self.mock_event_record, body=body))
+            open_job_result_upload.assert_called_once_with(self.job_id, ContentType="text/csv", ContentEncoding="gzip")
+            with open(set_job_status.call_args[1]["result_location"]["Path"], "rb") as fh:
+                lines = gzip.decompress(fh.read()).decode().splitlines()
+        self.assertEqual(lines[0].split(","), list(config.db.execute(self.query, self.params).keys()))
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(set_job_status.call_args[1]["result_row_count"], 10)
+
+    @patch("dcpquery.api.query_jobs.get_job_status", return_value=None)
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    def test_process_async_query_reports_progress(self, set_job_status, get_job_status):
+        config.db_statement_timeout_seconds = 880
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "async_query_fetch_size", 3), \
+                patch.object(config, "query_job_progress_interval_seconds", 0):
+            process_async_query(self.mock_event_record)
+        progress = [c[1]["progress"] for c in set_job_status.call_args_list if "progress" in c[1]]
+        self.assertEqual([p["phase"] for p in progress], ["executing"] + ["fetching"] * 4 + ["uploading"])
+        self.assertEqual([p["rows_fetched"] for p in progress], [0, 3, 6, 9, 10, 10])
+        self.assertEqual(progress[-1]["estimated_rows"], 10)
+        self.assertGreater(progress[-1]["bytes_written"], 0)
+
+        set_job_status.reset_mock()
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "async_query_fetch_size", 3):
+            process_async_query(self.mock_event_record)
+        progress = [c[1]["progress"] for c in set_job_status.call_args_list if "progress" in c[1]]
+        self.assertEqual([p["phase"] for p in progress], ["executing", "uploading"])
+
+    @patch("dcpquery.api.query_jobs.get_job_status")
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    def test_process_async_query_cancellation(self, set_job_status, get_job_status):
+        config.db_statement_timeout_seconds = 880
+        cancelled = {"job_id": self.job_id, "status": "cancelled"}
+        cancel_time = time.time() + 0.5
+        get_job_status.side_effect = lambda job_id: cancelled if time.time() > cancel_time else None
+        body = json.dumps(dict(query="SELECT pg_sleep(30)", params={}))
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "query_job_cancel_check_interval_seconds", 0.1):
+            process_async_query(dict(self.mock_event_record, body=body))
+        self.assertLess(time.time(), cancel_time + 10)
+        set_job_status.assert_called_with(self.job_id, status="cancelled", lane="interactive")
+        self.assertEqual(set_job_status.call_args_list[0][1]["progress"]["phase"], "executing")
+
+        set_job_status.reset_mock()
+        get_job_status.side_effect = None
+        get_job_status.return_value = cancelled
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td):
+            process_async_query(self.mock_event_record)
+            self.assertEqual(os.listdir(td), [])
+        set_job_status.assert_called_once_with(self.job_id, status="cancelled", lane="interactive")
+
+    @patch("dcpquery.api.query_jobs.clients")
+    @patch("dcpquery.api.query_jobs.process_async_query")
+    def test_process_async_queries(self, process_async_query, clients):
+        event_records = [dict(self.mock_event_record, messageId=str(i), receiptHandle=f"handle{i}") for i in range(6)]
+        running, max_running, lock = set(), [0], threading.Lock()
+
+        def process(event_record, lane, deadline):
+            with lock:
+                running.add(event_record["messageId"])
+                max_running[0] = max(max_running[0], len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(event_record["messageId"])
+            if event_record["messageId"] == "3":
+                raise Exception("Async query job failed")
+
+        process_async_query.side_effect = process
+        with patch.dict(config.async_query_lanes["bulk"], concurrency=3):
+            with self.assertRaises(DCPQueryError):
+                process_async_queries(event_records, lane="bulk")
+        self.assertEqual(process_async_query.call_count, 6)
+        process_async_query.assert_called_with(event_records[5], "bulk", None)
+        self.assertEqual(max_running[0], 3)
+        clients.sqs.get_queue_url.assert_called_once_with(QueueName=config.get_async_queries_queue_name("bulk"))
+        clients.sqs.delete_message_batch.assert_called_once()
+        deleted = [e["ReceiptHandle"] for e in clients.sqs.delete_message_batch.call_args[1]["Entries"]]
+        self.assertEqual(deleted, ["handle0", "handle1", "handle2", "handle4", "handle5"])
+
+        clients.reset_mock()
+        process_async_queries(event_records[:3])
+        clients.sqs.delete_message_batch.assert_not_called()
+
+        clients.sqs.delete_message_batch.side_effect = [{"Failed": [{"Id": "1", "Code": "InternalError"}]},
+                                                        {"Failed": [{"Id": "1", "Code": "InternalError"}]}]
+        with self.assertLogs("dcpquery.api.query_jobs", level="ERROR") as logs:
+            delete_sqs_messages(config.get_async_queries_queue_name("bulk"), event_records[:3])
+        retried = [e["ReceiptHandle"] for e in clients.sqs.delete_message_batch.call_args[1]["Entries"]]
+        self.assertEqual(retried, ["handle1"])
+        self.assertIn("Unable to delete message 1", logs.output[-1])
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after({"status": "new"}), config.query_job_min_retry_after_seconds)
+        progress = dict(phase="fetching", rows_fetched=100, elapsed_seconds=10, estimated_rows=400)
+        self.assertEqual(get_retry_after({"status": "running", "progress": progress}), 30)
+        progress.update(estimated_rows=None, elapsed_seconds=40)
+        self.assertEqual(get_retry_after({"status": "running", "progress": progress}), 10)
+        progress.update(elapsed_seconds=4000)
+        self.assertEqual(get_retry_after({"status": "running", "progress": progress}),
+                         config.query_job_max_retry_after_seconds)
+
+    @patch("dcpquery.api.query_jobs.get_job_status")
+    def test_get_with_wait(self, get_job_status):
+        running, done = {"job_id": self.job_id, "status": "running"}, {"job_id": self.job_id, "status": "done"}
+        with patch.object(config, "query_job_poll_interval_seconds", 0.01), \
+                patch.object(config, "query_job_max_poll_interval_seconds", 0.04), \
+                patch("dcpquery.api.query_jobs.time.sleep") as sleep:
+            get_job_status.side_effect = [running, running, done]
+            self.assertEqual(get(self.job_id, wait=5), done)
+            self.assertEqual(get_job_status.call_count, 3)
+
+            get_job_status.reset_mock()
+            sleep.reset_mock()
+            get_job_status.side_effect = [running] * 5 + [done]
+            self.assertEqual(get(self.job_id, wait=5), done)
+            self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.01, 0.02, 0.04, 0.04, 0.04])
+
+        get_job_status.reset_mock()
+        get_job_status.side_effect = None
+        get_job_status.return_value = running
+        with patch.object(config, "query_job_poll_interval_seconds", 0.01), \
+                patch.object(config, "query_job_max_wait_seconds", 0.05):
+            self.assertEqual(get(self.job_id, wait=5), running)
+        self.assertGreater(get_job_status.call_count, 1)
+
+    @patch("dcpquery.api.query_jobs.get_job_status", return_value=None)
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    def test_process_async_query_with_invalid_query(self, set_job_status, get_job_status):
         config.db_statement_timeout_seconds = 880
         body = json.dumps(dict(query="SELECT * FROM NONEXISTENT_TABLE", params={}))
         process_async_query(dict(self.mock_event_record, body=body))
@@ -43,6 +235,103 @@ class TestCreateAsyncQuery(unittest.TestCase):
         self.assertEqual(set_job_status_args[0][0], self.job_id)
         self.assertEqual(set_job_status_args[1]["status"], "failed")
 
+    @patch("dcpquery.api.query_jobs.write_job_result", side_effect=RuntimeError("upload failed"))
+    @patch("dcpquery.api.query_jobs.get_job_status", return_value=None)
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    def test_process_async_query_raises_unexpected_errors(self, set_job_status, get_job_status, write_job_result):
+        with self.assertRaises(RuntimeError):
+            process_async_query(self.mock_event_record)
+        # The job is retried, so it is not reported as failed, and a resubmitted query is coalesced with it
+        self.assertEqual(set_job_status.call_args[1]["status"], "new")
+        self.assertNotIn("failed", [c[1]["status"] for c in set_job_status.call_args_list])
+        attributes = dict(self.mock_event_record["attributes"], ApproximateReceiveCount="5")
+        process_async_query(dict(self.mock_event_record, attributes=attributes))
+        self.assertEqual(set_job_status.call_args[1]["status"], "failed")
+
+        set_job_status.reset_mock()
+        with patch("dcpquery.api.query_jobs.estimate_query_cost", side_effect=RuntimeError("EXPLAIN failed")):
+            process_async_query(dict(self.mock_event_record, attributes=attributes))
+        self.assertEqual(set_job_status.call_args[1]["status"], "failed")
+
+    @patch("dcpquery.api.query_jobs.socket.getaddrinfo", return_value=[(2, 1, 6, "", ("93.184.216.34", 443))])
+    @patch("dcpquery.api.query_jobs.requests.Session.post")
+    def test_process_async_query_sends_signed_callback(self, post, getaddrinfo):
+        config.db_statement_timeout_seconds = 880
+        post.side_effect = [requests.exceptions.ConnectionError(), MagicMock(status_code=503),
+                            MagicMock(status_code=200)]
+        body = json.dumps(dict(query=self.query, params=self.params, callback_url="https://example.com/callback"))
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "job_store_url", td), patch.object(config, "job_callback_backoff_seconds", 0), \
+                patch.object(config, "_job_callback_key", ("key1", "secret")):
+            process_async_query(dict(self.mock_event_record, body=body))
+        self.assertEqual(post.call_count, 3)
+        args, kwargs = post.call_args
+        # The callback is sent to the address that was checked, with the callback URL's host name
+        self.assertEqual(args[0], "https://93.184.216.34:443/callback")
+        self.assertEqual(kwargs["headers"]["Host"], "example.com")
+        self.assertFalse(kwargs["allow_redirects"])
+        job_status = json.loads(kwargs["data"])
+        self.assertEqual(job_status["status"], "done")
+        self.assertEqual(job_status["result_row_count"], 10)
+        self.assertNotIn("result_chunks", job_status)
+        signed_request = requests.Request("POST", args[0], data=kwargs["data"], headers=kwargs["headers"],
+                                          auth=kwargs["auth"]).prepare()
+        signed_headers = HTTPSignatureAuth.get_sig_struct(signed_request)["headers"].split()
+        self.assertEqual(set(signed_headers), {"(request-target)", "host", "date", "digest"})
+        HTTPSignatureAuth.verify(signed_request, key_resolver=lambda key_id, algorithm: b"secret")
+        with self.assertRaises(Exception):
+            HTTPSignatureAuth.verify(signed_request, key_resolver=lambda key_id, algorithm: b"other")
+
+    @patch("dcpquery.api.query_jobs.requests.Session.post")
+    def test_send_job_callback_gives_up(self, post):
+        job_status = {"job_id": self.job_id, "status": "done"}
+        with patch.object(type(config), "job_callback_key", PropertyMock(side_effect=Exception("no secret"))):
+            self.assertFalse(send_job_callback("https://93.184.216.34/callback", job_status))
+        post.assert_not_called()
+
+        post.return_value = MagicMock(status_code=503)
+        with patch.object(config, "_job_callback_key", ("key1", "secret")), \
+                patch.object(config, "job_callback_backoff_seconds", 0):
+            self.assertFalse(send_job_callback("https://10.0.0.1/callback", job_status))
+            post.assert_not_called()
+            self.assertFalse(send_job_callback("https://93.184.216.34/callback", job_status, deadline=time.time()))
+            post.assert_not_called()
+            with patch.object(config, "job_callback_timeout_seconds", 1), \
+                    patch.object(config, "job_callback_backoff_seconds", 1), \
+                    patch.object(config, "job_callback_deadline_margin_seconds", 0):
+                self.assertFalse(send_job_callback("https://93.184.216.34/callback", job_status,
+                                                   deadline=time.time() + 1.5))
+            self.assertEqual(post.call_count, 1)
+
+    @patch("dcpquery.api.query_jobs.requests.Session.post")
+    def test_post_to_address(self, post):
+        with patch("dcpquery.api.query_jobs.requests.Session.mount") as mount:
+            post_to_address("https://example.com:8443/callback?a=1", ipaddress.ip_address("2606:2800:220:1::1"),
+                            headers={"Content-Type": "application/json"}, data=b"{}")
+        args, kwargs = post.call_args
+        self.assertEqual(args[0], "https://[2606:2800:220:1::1]:8443/callback?a=1")
+        self.assertEqual(kwargs["headers"], {"Content-Type": "application/json", "Host": "example.com:8443"})
+        self.assertFalse(kwargs["allow_redirects"])
+        adapter = mount.call_args[0][1]
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["server_hostname"], "example.com")
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["assert_hostname"], "example.com")
+
+    @patch("dcpquery.api.query_jobs.socket.getaddrinfo")
+    def test_check_callback_url(self, getaddrinfo):
+        getaddrinfo.return_value = [(2, 1, 6, "", ("93.184.216.34", 443))]
+        self.assertEqual(check_callback_url("https://example.com/callback"), [ipaddress.ip_address("93.184.216.34")])
+        check_callback_url("https://93.184.216.34:8443/callback")
+        for url in ["http://example.com/callback", "ftp://example.com/", "https:///callback", "https://127.0.0.1/",
+                    "https://10.1.2.3/", "https://169.254.169.254/latest/meta-data/", "https://[::1]/",
+                    "https://[::ffff:10.0.0.1]/", "https://[fe80::1]/", "https://example.com:99999/"]:
+            with self.assertRaises(DCPQueryError, msg=url) as e:
+                check_callback_url(url)
+            self.assertEqual(e.exception.status, requests.codes.bad_request)
+        getaddrinfo.return_value = [(2, 1, 6, "", ("93.184.216.34", 443)), (2, 1, 6, "", ("192.168.0.1", 443))]
+        with self.assertRaises(DCPQueryError):
+            check_callback_url("https://example.com/callback")
+        check_callback_url("https://example.com/callback", resolve=False)
+
     @patch("dcpquery.api.query_job.set_job_status")
     @patch("dcpquery.api.query_job.aws.resources.sqs.Queue")
     def test_create_async_query_calls_process_async_func_with_correct_args(self, sqs, set_job_status):
@@ -50,6 +339,88 @@ class TestCreateAsyncQuery(unittest.TestCase):
         set_job_status.assert_called()
         sqs.assert_called()
 
+    @patch("dcpquery.api.query_job.index_job")
+    @patch("dcpquery.api.query_job.find_job_id")
+    @patch("dcpquery.api.query_job.set_job_status")
+    @patch("dcpquery.api.query_job.aws")
+    def test_create_async_query_deduplicates_jobs(self, aws, set_job_status, find_job_id, index_job):
+        aws.resources.sqs.Queue.return_value.send_message.return_value = {"MessageId": self.job_id}
+        find_job_id.return_value = None
+        self.assertEqual(create_async_query_job(self.query, self.params), self.job_id)
+        fingerprint = find_job_id.call_args[0][0]
+        index_job.assert_called_once_with(fingerprint, self.job_id)
+
+        find_job_id.return_value = "existing-job"
+        aws.reset_mock()
+        self.assertEqual(create_async_query_job(self.query, self.params), "existing-job")
+        self.assertEqual(find_job_id.call_args[0][0], fingerprint)
+        aws.resources.sqs.Queue.return_value.send_message.assert_not_called()
+
+        self.assertEqual(create_async_query_job(self.query, self.params, force=True), self.job_id)
+        aws.resources.sqs.Queue.return_value.send_message.assert_called_once()
+
+        find_job_id.reset_mock()
+        create_async_query_job(self.query, self.params, output_format="csv")
+        self.assertNotEqual(find_job_id.call_args[0][0], fingerprint)
+        find_job_id.reset_mock()
+        bump_data_generation()
+        create_async_query_job(self.query, self.params)
+        self.assertNotEqual(find_job_id.call_args[0][0], fingerprint)
+
+    @patch("dcpquery.api.query_job.index_job")
+    @patch("dcpquery.api.query_job.estimate_query_cost")
+    @patch("dcpquery.api.query_job.set_job_status")
+    @patch("dcpquery.api.query_job.aws")
+    def test_create_async_query_chooses_lane(self, aws, set_job_status, estimate_query_cost, index_job):
+        send_message = aws.resources.sqs.Queue.return_value.send_message
+        send_message.return_value = {"MessageId": self.job_id}
+        for caller, estimated_cost, lane in [("10.0.0.1", 100, "interactive"),
+                                             ("10.0.0.1", config.async_query_bulk_min_estimated_cost + 1, "bulk"),
+                                             ("service", 100, "internal")]:
+            estimate_query_cost.return_value = (estimated_cost, 10)
+            create_async_query_job(self.query, self.params, force=True, caller=caller)
+            aws.clients.sqs.get_queue_url.assert_called_with(QueueName=config.get_async_queries_queue_name(lane))
+            self.assertEqual(send_message.call_args[1]["MessageGroupId"],
+                             get_message_group_id(caller, send_message.call_args[1]["MessageBody"]))
+            self.assertEqual(json.loads(send_message.call_args[1]["MessageBody"])["lane"], lane)
+            set_job_status.assert_called_with(job_id=self.job_id, status="new", lane=lane)
+
+    def test_get_caller(self):
+        with patch.object(config, "app", None):
+            self.assertEqual(get_caller(), "service")
+        identity = {"sourceIp": "10.0.0.1", "apiKeyId": None, "userArn": None, "cognitoIdentityId": None}
+        with patch.object(config, "app") as app:
+            for key, caller in [("sourceIp", "10.0.0.1"), ("apiKeyId", "key"), ("userArn", "arn:aws:iam::1:user/u"),
+                                ("cognitoIdentityId", "us-east-1:1")]:
+                identity[key] = caller
+                app.current_request.context = {"identity": identity}
+                self.assertEqual(get_caller(), caller)
+            app.current_request.context = {}
+            self.assertEqual(get_caller(), "anonymous")
+
+    def test_get_message_group_id(self):
+        group_ids = {get_message_group_id("10.0.0.1", json.dumps(dict(query=str(i)))) for i in range(100)}
+        self.assertEqual(len(group_ids), config.async_query_message_group_buckets)
+        self.assertTrue(all(len(group_id) <= 128 for group_id in group_ids))
+        self.assertEqual(group_ids & {get_message_group_id("10.0.0.2", json.dumps(dict(query=str(i))))
+                                      for i in range(100)}, set())
+
+    @patch("dcpquery.api.query_jobs.get_job_status")
+    @patch("dcpquery.api.query_jobs.get_job_store")
+    def test_find_job_id(self, get_job_store, get_job_status):
+        job_store = get_job_store.return_value
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for status, age, found in [("new", 0, True), ("running", 0, True), ("failed", 0, False), ("done", 60, True),
+                                   ("done", config.query_job_result_retention_seconds + 60, False)]:
+            job_store.get_index.return_value = (self.job_id, now - datetime.timedelta(seconds=age))
+            get_job_status.return_value = {"job_id": self.job_id, "status": status}
+            self.assertEqual(find_job_id("fingerprint"), self.job_id if found else None)
+        job_store.get_index.assert_called_with("fingerprint")
+        get_job_status.return_value = None
+        self.assertIsNone(find_job_id("fingerprint"))
+        job_store.get_index.return_value = None
+        self.assertIsNone(find_job_id("fingerprint"))
+
 
 if __name__ == '__main__':
     unittest.main()
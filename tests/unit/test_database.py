@@ -3,9 +3,12 @@ import sys
 
 import sqlalchemy
 import unittest
+from unittest.mock import patch, PropertyMock
 
 from dcpquery import config
-from dcpquery.db import drop_db, init_db
+from dcpquery.db import (drop_db, init_db, run_query, estimate_query_cost, query_fingerprint, _explain_query,
+                         get_data_generation, bump_data_generation)
+from dcpquery.exceptions import QueryTimeoutError
 from dcpquery.db.models import Bundle, File, BundleFileLink, Process, ProcessFileLink
 from tests import vx_bf_links
 
@@ -23,6 +26,92 @@ class TestReadOnlyTransactions(unittest.TestCase):
         self.assertEqual(list(dict(row).keys()), expected_column_names)
 
 
+class TestRunQuery(unittest.TestCase):
+    def test_run_query_streams_results(self):
+        expected_rows = config.db.execute("SELECT fqid FROM files ORDER BY fqid").fetchall()
+        cursor = run_query("SELECT fqid FROM files ORDER BY fqid", {}, rows_per_page=2)
+        self.assertTrue(cursor.stream_results)
+        self.assertEqual(cursor.keys(), ["fqid"])
+        pages = list(cursor.pages())
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertEqual([row for page in pages for row in page], expected_rows)
+        self.assertIsNone(cursor._connection)
+
+    def test_run_query_does_not_stream_multiple_statements(self):
+        cursor = run_query("SELECT 1 AS a; SELECT 2 AS b", {})
+        self.assertFalse(cursor.stream_results)
+        self.assertEqual([dict(row) for row in cursor], [{"b": 2}])
+
+    def test_run_query_streaming_timeout(self):
+        cursor = run_query("SELECT pg_sleep(0.5) FROM generate_series(1, 5)", {}, rows_per_page=1, timeout_seconds=1)
+        with self.assertRaises(QueryTimeoutError):
+            list(cursor)
+        self.assertIsNone(cursor._connection)
+
+    def test_run_query_description(self):
+        queries = ["SELECT fqid, size FROM files WHERE false",
+                   "SELECT 1; SELECT 'a'::varchar AS fqid, 2::bigint AS size"]
+        for query in queries:
+            with run_query(query, {}) as cursor:
+                self.assertEqual(list(cursor), [] if "false" in query else [("a", 2)])
+                self.assertEqual([(c.name, c.type_code) for c in cursor.description], [("fqid", 1043), ("size", 20)])
+
+    def test_run_query_statement_timeout(self):
+        db = config.db
+        with run_query("SHOW statement_timeout", {}, timeout_seconds=7) as cursor:
+            self.assertEqual(list(cursor), [("7s",)])
+        orig_timeout_seconds = config.db_statement_timeout_seconds
+        try:
+            config.reset_db_timeout_seconds(3)
+            with run_query("SHOW statement_timeout", {}) as cursor:
+                self.assertEqual(list(cursor), [("3s",)])
+            self.assertEqual(config.db_session.execute("SHOW statement_timeout").scalar(), "3s")
+            config.db_session.rollback()
+        finally:
+            config.reset_db_timeout_seconds(orig_timeout_seconds)
+        with self.assertRaises(QueryTimeoutError):
+            list(run_query("SELECT pg_sleep(2)", {}, timeout_seconds=1))
+        self.assertIs(config.db, db)
+        self.assertEqual(config.db.pool.checkedout(), 0)
+
+    def test_estimate_query_cost(self):
+        total_cost, plan_rows = estimate_query_cost("SELECT * FROM files WHERE size > %(s)s", {"s": 0})
+        self.assertGreater(total_cost, 0)
+        self.assertGreater(plan_rows, 0)
+        hits = _explain_query.cache_info().hits
+        estimate_query_cost("SELECT * FROM files WHERE size > %(s)s", {"s": 0})
+        self.assertEqual(_explain_query.cache_info().hits, hits + 1)
+        self.assertIsNotNone(estimate_query_cost("SELECT *\n  FROM files\n  WHERE size > %(s)s;", {"s": 0}))
+        self.assertEqual(_explain_query.cache_info().hits, hits + 1)
+        self.assertIsNone(estimate_query_cost("SELECT 1; SELECT 2", {}))
+        misses = _explain_query.cache_info().misses
+        self.assertIsNone(estimate_query_cost("SELECT * FROM nonexistent_table", {}))
+        self.assertIsNone(estimate_query_cost("SELECT * FROM nonexistent_table", {}))
+        self.assertEqual(_explain_query.cache_info().misses, misses + 2)
+        bump_data_generation()
+        estimate_query_cost("SELECT * FROM files WHERE size > %(s)s", {"s": 0})
+        self.assertEqual(_explain_query.cache_info().hits, hits + 1)
+
+    @patch("dcpquery.db._data_generation", (None, 0.0))
+    def test_get_data_generation(self):
+        data_generation = get_data_generation()
+        with patch.object(type(config), "db", new_callable=PropertyMock) as db_property:
+            db = db_property.return_value
+            self.assertEqual(get_data_generation(), data_generation)
+            db.execute.assert_not_called()
+            db.execute.return_value.scalar.return_value = data_generation + 1
+            with patch.object(config, "data_generation_max_age_seconds", -1):
+                self.assertEqual(get_data_generation(), data_generation + 1)
+            db.execute.assert_called_once_with("SELECT last_value FROM data_generation")
+
+    def test_query_fingerprint(self):
+        self.assertEqual(query_fingerprint("SELECT 'a  b'", {}), query_fingerprint("SELECT 'a  b'", {}))
+        self.assertNotEqual(query_fingerprint("SELECT 'a  b'", {}), query_fingerprint("SELECT 'a b'", {}))
+        self.assertNotEqual(query_fingerprint("SELECT 1 -- x\n+ 1", {}), query_fingerprint("SELECT 1 -- x + 1", {}))
+        self.assertNotEqual(query_fingerprint("SELECT %(a)s", {"a": 1}), query_fingerprint("SELECT %(a)s", {"a": 2}))
+        self.assertNotEqual(query_fingerprint("SELECT 1", {}, "json"), query_fingerprint("SELECT 1", {}, "csv"))
+
+
 # Note: these tests alter global state and so may not play well with other concurrent tests/operations
 class TestDBRules(unittest.TestCase):
     @classmethod
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3.6
 
 import json
+import os
+import tempfile
 import unittest
 from contextlib import contextmanager
 
 from unittest.mock import patch
 
 import requests
+import pyarrow
 from requests_http_signature import HTTPSignatureAuth
 
 from dcpquery import config
+from dcpquery.api.result_cache import query_result_cache
+from dcpquery.api.compression import compressed_bodies
+from dcpquery.db import bump_data_generation, QueryCursor
+from dcpquery.exceptions import QueryTimeoutError
 from dcpquery.api.files.schema_type import get_file_fqids_for_schema_type_version
 from tests import fast_query_mock_result, fast_query_expected_results
 from tests.unit import TestChaliceApp, DCPAssertMixin, DCPQueryUnitTest
@@ -19,6 +26,7 @@ class TestEndpoints(TestChaliceApp, DCPQueryUnitTest):
     def setUp(self):
         super().setUp()
         self.uuid = "3d8608c3-0ca6-430a-9f90-2117be6af160"
+        query_result_cache.clear()
 
     def test_healthcheck_endpoint(self):
         response = self.app.get("/internal/health")
@@ -41,10 +49,228 @@ class TestEndpoints(TestChaliceApp, DCPQueryUnitTest):
             self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
 
     def test_query_endpoint_redirects_too_large_responses(self):
-        config.API_GATEWAY_MAX_RESULT_SIZE = 10
         query = "select * from files"
-        self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
-        config.API_GATEWAY_MAX_RESULT_SIZE = 8 * 1024 * 1024
+        with patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", 10):
+            self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
+
+    def test_query_endpoint_result_cache(self):
+        query = "select fqid, size from files order by fqid limit 5"
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        self.assertEqual(res.response.headers["X-Cache"], "miss")
+        with patch("dcpquery.api.query.run_query") as run_query:
+            cached_res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+            run_query.assert_not_called()
+        self.assertEqual(cached_res.response.headers["X-Cache"], "hit")
+        self.assertEqual(cached_res.json, res.json)
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                  headers={"Cache-Control": "no-cache"})
+        self.assertEqual(res.response.headers["X-Cache"], "bypass")
+        bump_data_generation()
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        self.assertEqual(res.response.headers["X-Cache"], "miss")
+
+    def test_response_compression(self):
+        compressed_bodies.clear()
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": "select 1 as x"})
+        self.assertNotIn("Content-Encoding", res.response.headers)
+        self.assertNotIn("Server-Timing", res.response.headers)
+        query = "select * from files order by fqid limit 10"
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        self.assertEqual(res.response.headers["Content-Encoding"], "br")
+        # Sync query results are compressed while they are encoded, and the response reuses the compressed body
+        self.assertRegex(res.response.headers["Server-Timing"], r'^compress;dur=[0-9.]+;desc="br cached"$')
+        self.assertEqual(len(res.json["results"]), 10)
+        # The handed over body is not kept in the cache of compressed bodies, unlike the bodies of cache hits
+        self.assertEqual(compressed_bodies.size, 0)
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        self.assertEqual(res.response.headers["X-Cache"], "hit")
+        self.assertRegex(res.response.headers["Server-Timing"], r'^compress;dur=[0-9.]+;desc="br 5"$')
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        self.assertRegex(res.response.headers["Server-Timing"], r'^compress;dur=[0-9.]+;desc="br cached"$')
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                  headers={"accept-encoding": "gzip"})
+        self.assertEqual(res.response.headers["Content-Encoding"], "gzip")
+
+    @patch("dcpquery.api.query.create_async_query_job", return_value="26f0424a-fdce-455f-ac2e-f8f5619c6eda")
+    def test_query_endpoint_size_limit_applies_to_compressed_result(self, create_async_query_job):
+        query = "select * from files order by fqid"
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                  headers={"accept-encoding": "identity"})
+        with patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", len(res.body) // 2), \
+                patch.object(config, "sync_query_handoff", False):
+            compressed_res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                                 headers={"accept-encoding": "br"})
+            self.assertEqual(compressed_res.json, res.json)
+            create_async_query_job.assert_not_called()
+            self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query},
+                                headers={"accept-encoding": "identity"})
+            create_async_query_job.assert_called_once_with(query, {}, output_format="json")
+            # The compressed result is cached with the result, so a cache hit is served compressed as it was checked
+            compressed_bodies.clear()
+            cached_res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                             headers={"accept-encoding": "br"})
+            self.assertEqual(cached_res.response.headers["X-Cache"], "hit")
+            self.assertRegex(cached_res.response.headers["Server-Timing"], r'desc="br cached"$')
+            self.assertEqual(cached_res.json, res.json)
+            compressed_result = query_result_cache.get(query_result_cache.key(query, {}, "json") + ".br")
+            create_async_query_job.reset_mock()
+            with patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", len(compressed_result) - 1):
+                self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query},
+                                    headers={"accept-encoding": "br"})
+            create_async_query_job.assert_called_once_with(query, {}, output_format="json")
+
+    def test_fast_path_dispatch(self):
+        connexion_app = self.app._chalice_app.connexion_app.app
+        query = "select fqid, size from files order by fqid limit 3"
+        job_id = "26f0424a-fdce-455f-ac2e-f8f5619c6eda"
+        with patch.object(connexion_app, "full_dispatch_request", wraps=connexion_app.full_dispatch_request) as fdr:
+            res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                      headers={"cache-control": "no-cache"})
+            bad_request = self.assertResponse("POST", "/v1/query", requests.codes.bad_request,
+                                              {"query": query, "output_format": "xml"})
+            with patch("dcpquery.api.query_jobs.get_job_status", return_value=None):
+                not_found = self.assertResponse("GET", f"/v1/query_jobs/{job_id}?wait=1", requests.codes.not_found)
+            bad_param = self.assertResponse("GET", f"/v1/query_jobs/{job_id}?wait=100", requests.codes.bad_request)
+            with patch("connexion.operations.AbstractOperation.get_arguments", side_effect=ValueError("bad")):
+                internal_error = self.assertResponse("GET", f"/v1/query_jobs/{job_id}?wait=1",
+                                                     requests.codes.internal_server_error)
+            fdr.assert_not_called()
+            with patch.object(config, "api_fast_path", False):
+                self.assertEqual(self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query},
+                                                     headers={"cache-control": "no-cache"}).json, res.json)
+                self.assertEqual(self.assertResponse("POST", "/v1/query", requests.codes.bad_request,
+                                                     {"query": query, "output_format": "xml"}).json,
+                                 bad_request.json)
+                self.assertEqual(self.assertResponse("GET", f"/v1/query_jobs/{job_id}?wait=100",
+                                                     requests.codes.bad_request).json, bad_param.json)
+            self.assertEqual(fdr.call_count, 3)
+        self.assertEqual(not_found.body, b"{}")
+        self.assertEqual(bad_request.response.headers["Content-Type"], "application/problem+json")
+        self.assertEqual(internal_error.response.headers["Content-Type"], "application/problem+json")
+
+    def test_response_validation(self):
+        job_id = "26f0424a-fdce-455f-ac2e-f8f5619c6eda"
+        job_status = {"job_id": job_id, "status": "unknown"}
+        with patch("dcpquery.api.query_jobs.get_job_status", return_value=job_status), \
+                patch("dcpquery.api.response_validation.put_metric") as put_metric:
+            with patch.object(config, "response_validation_sample_rate", 0):
+                self.assertResponse("GET", f"/v1/query_jobs/{job_id}", requests.codes.ok)
+            put_metric.assert_not_called()
+            with patch.object(config, "response_validation_sample_rate", 1):
+                res = self.assertResponse("GET", f"/v1/query_jobs/{job_id}", requests.codes.internal_server_error)
+                self.assertEqual(res.json["title"], "Response body does not conform to specification")
+                put_metric.assert_called_with("ResponseValidationTime", unittest.mock.ANY, "Milliseconds",
+                                              Route="GET /query_jobs/{job_id}", Mode="full")
+                with patch.object(config, "api_fast_path", False):
+                    self.assertResponse("GET", f"/v1/query_jobs/{job_id}", requests.codes.internal_server_error)
+                with patch.object(config, "response_validation_max_full_size", 0):
+                    self.assertResponse("GET", f"/v1/query_jobs/{job_id}", requests.codes.ok)
+                put_metric.assert_called_with("ResponseValidationTime", unittest.mock.ANY, "Milliseconds",
+                                              Route="GET /query_jobs/{job_id}", Mode="top_level")
+                with patch.object(config, "response_validation_max_size", 0):
+                    self.assertResponse("GET", f"/v1/query_jobs/{job_id}", requests.codes.ok)
+            self.assertEqual(put_metric.call_count, 3)
+
+    def test_query_endpoint_compact_json_output_format(self):
+        query = "select fqid, size, body from files order by fqid limit 10"
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query})
+        compact_res = self.assertResponse("POST", "/v1/query", requests.codes.ok,
+                                          {"query": query, "output_format": "compact_json"})
+        self.assertEqual(compact_res.json["columns"], ["fqid", "size", "body"])
+        self.assertEqual([dict(zip(compact_res.json["columns"], row)) for row in compact_res.json["results"]],
+                         res.json["results"])
+        self.assertLess(len(compact_res.body), len(res.body))
+
+    def test_query_endpoint_arrow_output_format(self):
+        query = "select fqid, size, body from files order by fqid limit 10"
+        res = self.assertResponse("POST", "/v1/query", requests.codes.ok, {"query": query, "output_format": "arrow"})
+        self.assertEqual(res.response.headers["Content-Type"], "application/vnd.apache.arrow.stream")
+        table = pyarrow.ipc.open_stream(res.response.content).read_all()
+        self.assertEqual(table.schema.names, ["fqid", "size", "body"])
+        self.assertEqual(table.column("fqid").to_pylist(), [row[0] for row in config.db.execute(query)])
+        self.assertEqual(json.loads(table.column("body")[0].as_py()), config.db.execute(query).first()[2])
+
+    @patch("dcpquery.api.query.create_async_query_job", return_value="26f0424a-fdce-455f-ac2e-f8f5619c6eda")
+    def test_query_endpoint_redirects_expensive_queries(self, create_async_query_job):
+        query = "select * from files"
+        with patch.object(config, "sync_query_max_estimated_rows", 0):
+            self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
+        create_async_query_job.assert_called_once_with(query, {}, output_format="json")
+
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    @patch("dcpquery.api.query.create_async_query_job")
+    def test_query_endpoint_hands_off_too_large_responses(self, create_async_query_job, set_job_status):
+        query = "select fqid from files order by fqid"
+        expected_fqids = [row[0] for row in config.db.execute(query)]
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", 300):
+            res = self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
+            create_async_query_job.assert_not_called()
+            job_id = set_job_status.call_args[0][0]
+            self.assertIn(f"query_jobs/{job_id}?", res.response.headers["Location"])
+            with open(set_job_status.call_args[1]["result_location"]["Path"]) as fh:
+                job_result = json.load(fh)
+        self.assertEqual(job_result["status"], "done")
+        self.assertEqual([row["fqid"] for row in job_result["result"]], expected_fqids)
+        self.assertEqual(set_job_status.call_args[1]["status"], "done")
+        self.assertEqual(set_job_status.call_args[1]["result_row_count"], len(expected_fqids))
+
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", 300):
+            self.assertResponse("POST", "/v1/query", requests.codes.found,
+                                {"query": query, "output_format": "compact_json"})
+            with open(set_job_status.call_args[1]["result_location"]["Path"]) as fh:
+                job_result = json.load(fh)
+        self.assertEqual(job_result["columns"], ["fqid"])
+        self.assertEqual(job_result["result"], [[fqid] for fqid in expected_fqids])
+
+    @patch("dcpquery.api.query_jobs.set_job_status")
+    @patch("dcpquery.api.query.create_async_query_job", return_value="26f0424a-fdce-455f-ac2e-f8f5619c6eda")
+    def test_query_endpoint_hand_off_falls_back_to_async_job(self, create_async_query_job, set_job_status):
+        query = "select fqid from files order by fqid"
+        fetch_page, pages_fetched = QueryCursor.fetch_page, []
+
+        def fetch_first_page(cursor):
+            # Lets the sync query overflow on its first page, then times out the hand-off
+            if pages_fetched:
+                raise QueryTimeoutError(title="Query exceeded time limit", detail=str(cursor.timeout_seconds))
+            pages_fetched.append(cursor)
+            return fetch_page(cursor)
+
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "local_job_result_dir", td), \
+                patch.object(config, "API_GATEWAY_MAX_RESULT_SIZE", 300), \
+                patch.object(QueryCursor, "fetch_page", fetch_first_page):
+            res = self.assertResponse("POST", "/v1/query", requests.codes.found, {"query": query})
+            self.assertEqual([name for _, _, names in os.walk(td) for name in names], [])
+        self.assertIn("query_jobs/26f0424a-fdce-455f-ac2e-f8f5619c6eda?", res.response.headers["Location"])
+        create_async_query_job.assert_called_once_with(query, {}, output_format="json")
+        set_job_status.assert_not_called()
+
+    @patch("dcpquery.api.query_job.create_async_query_job", return_value="26f0424a-fdce-455f-ac2e-f8f5619c6eda")
+    def test_query_job_endpoint_output_format(self, create_async_query_job):
+        body = {"query": "select * from files", "output_format": "ndjson", "compression": "br"}
+        res = self.assertResponse("POST", "/v1/query_job", requests.codes.accepted, body)
+        self.assertEqual(res.json["output_format"], "ndjson")
+        create_async_query_job.assert_called_once_with("select * from files", {}, output_format="ndjson",
+                                                       compression="br", force=False, callback_url=None)
+        body = {"query": "select * from files", "output_format": "xml"}
+        self.assertResponse("POST", "/v1/query_job", requests.codes.bad_request, body)
+
+    @patch("dcpquery.api.query_jobs.get_job_store")
+    @patch("dcpquery.api.query_jobs.get_job_status")
+    def test_cancel_query_job_endpoint(self, get_job_status, get_job_store):
+        job_id = "26f0424a-fdce-455f-ac2e-f8f5619c6eda"
+        get_job_status.return_value = {"job_id": job_id, "status": "running", "lane": "bulk"}
+        res = self.assertResponse("DELETE", f"/v1/query_jobs/{job_id}", requests.codes.ok)
+        self.assertEqual(res.json["status"], "cancelled")
+        get_job_store.return_value.cancel.assert_called_once_with(
+            job_id, {"job_id": job_id, "status": "cancelled", "error": None, "result_location": None, "lane": "bulk"}
+        )
+
+        get_job_status.return_value = {"job_id": job_id, "status": "done"}
+        self.assertResponse("DELETE", f"/v1/query_jobs/{job_id}", requests.codes.conflict)
+        get_job_status.return_value = None
+        self.assertResponse("DELETE", f"/v1/query_jobs/{job_id}", requests.codes.not_found)
 
     @patch('dcplib.aws.resources.sqs.Queue')
     def test_webhook_endpoint(self, mock_sqs_queue):
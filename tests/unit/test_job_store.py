@@ -0,0 +1,74 @@
+import os, sys, io, datetime, tempfile, unittest
+from unittest.mock import patch
+
+import botocore
+
+from dcpquery import config
+from dcpquery.api.job_store import S3JobStore, LocalDirJobStore, SQLiteJobStore, open_job_store, get_job_store
+from dcpquery.api.query_jobs import set_job_status, get_job_status, find_job_id, index_job
+
+
+class TestJobStore(unittest.TestCase):
+    job_id = "26f0424a-fdce-455f-ac2e-f8f5619c6eda"
+
+    def check_job_store(self, job_store):
+        self.assertIsNone(job_store.get_status(self.job_id))
+        job_store.put_status(self.job_id, {"job_id": self.job_id, "status": "new"})
+        job_store.put_status(self.job_id, {"job_id": self.job_id, "status": "running"})
+        self.assertEqual(job_store.get_status(self.job_id), {"job_id": self.job_id, "status": "running"})
+        job_store.cancel(self.job_id, {"job_id": self.job_id, "status": "cancelled"})
+        job_store.put_status(self.job_id, {"job_id": self.job_id, "status": "done"})
+        self.assertEqual(job_store.get_status(self.job_id), {"job_id": self.job_id, "status": "cancelled"})
+        job_store.put_status("other", {"job_id": "other", "status": "running"})
+        self.assertEqual(job_store.get_status("other"), {"job_id": "other", "status": "running"})
+        self.assertIsNone(job_store.get_index("fingerprint"))
+        job_store.put_index("fingerprint", self.job_id)
+        job_id, indexed_at = job_store.get_index("fingerprint")
+        self.assertEqual(job_id, self.job_id)
+        self.assertLess(datetime.datetime.now(datetime.timezone.utc) - indexed_at, datetime.timedelta(seconds=60))
+        self.assertEqual(job_store.get_result_url({"Path": "/tmp/result"}), "file:///tmp/result")
+
+    def test_local_dir_job_store(self):
+        with tempfile.TemporaryDirectory() as td:
+            self.check_job_store(LocalDirJobStore(td))
+            self.assertIsInstance(open_job_store(td), LocalDirJobStore)
+
+    def test_sqlite_job_store(self):
+        self.check_job_store(SQLiteJobStore())
+        with tempfile.TemporaryDirectory() as td:
+            self.check_job_store(SQLiteJobStore(os.path.join(td, "jobs.db")))
+            job_store = open_job_store(f"sqlite://{td}/jobs.db")
+            self.assertIsInstance(job_store, SQLiteJobStore)
+            self.assertEqual(job_store.get_status(self.job_id)["status"], "cancelled")
+
+    @patch("dcpquery.api.job_store.clients")
+    def test_s3_job_store(self, clients):
+        job_store = open_job_store("s3://bucket/prefix/")
+        self.assertIsInstance(job_store, S3JobStore)
+        no_such_key = botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        clients.s3.get_object.side_effect = [{"Body": io.BytesIO(b'{"status": "done"}')}, no_such_key]
+        self.assertEqual(job_store.get_status(self.job_id), {"status": "done"})
+        clients.s3.get_object.assert_any_call(Bucket="bucket", Key=f"prefix/job_status/{self.job_id}")
+        clients.s3.get_object.assert_called_with(Bucket="bucket", Key=f"prefix/job_cancellation/{self.job_id}")
+        clients.s3.get_object.side_effect = [{"Body": io.BytesIO(b'{"status": "cancelled"}')}]
+        self.assertEqual(job_store.get_status(self.job_id), {"status": "cancelled"})
+
+        clients.s3.generate_presigned_url.side_effect = ["url1", "url2"]
+        result_location = {"Bucket": "bucket", "Key": f"job_result/{self.job_id}"}
+        self.assertEqual(job_store.get_result_url(result_location), "url1")
+        self.assertEqual(job_store.get_result_url(result_location), "url1")
+        with patch.object(config, "job_result_url_refresh_seconds", config.job_result_url_expiration_seconds + 1):
+            self.assertEqual(job_store.get_result_url(result_location), "url2")
+        self.assertEqual(clients.s3.generate_presigned_url.call_count, 2)
+
+    def test_query_jobs_use_configured_job_store(self):
+        with patch.object(config, "job_store_url", "sqlite://"):
+            self.assertIsInstance(get_job_store(), SQLiteJobStore)
+            set_job_status(self.job_id, status="running", lane="interactive")
+            self.assertEqual(get_job_status(self.job_id)["lane"], "interactive")
+            index_job("fingerprint", self.job_id)
+            self.assertEqual(find_job_id("fingerprint"), self.job_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import os, sys, unittest
+
+from dcpquery.api.response_validation import get_top_level_schema
+
+
+class TestResponseValidation(unittest.TestCase):
+    def test_get_top_level_schema(self):
+        schema = {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "query": {"type": "string", "nullable": True},
+                "results": {"type": "array", "items": {"type": "object", "properties": {"size": {"type": "integer"}}}},
+                "status": {"type": "string", "enum": ["new", "done"]}
+            },
+            "allOf": [{"type": "object", "properties": {"lane": {"type": "string", "enum": ["bulk"]}}}]
+        }
+        self.assertEqual(get_top_level_schema(schema), {
+            "type": "object",
+            "required": ["results"],
+            "properties": {"query": {"type": "string", "nullable": True}, "results": {"type": "array"},
+                           "status": {"type": "string"}},
+            "allOf": [{"type": "object", "properties": {"lane": {"type": "string"}}}]
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os, sys, tempfile, unittest
+from unittest.mock import patch
+
+from dcpquery import config
+from dcpquery.api.result_cache import LRUCache, QueryResultCache
+from dcpquery.db import get_data_generation, bump_data_generation
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru_cache_eviction(self):
+        cache = LRUCache(max_size=10)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        cache.get("a")
+        cache.put("c", b"1234")
+        self.assertEqual(cache.get("a"), b"1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.size, 8)
+        cache.put("d", b"12345678901")
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.size, 8)
+
+
+class TestQueryResultCache(unittest.TestCase):
+    def test_query_result_cache_key(self):
+        cache = QueryResultCache()
+        key = cache.key("select * from files where size > %(s)s", {"s": 0}, "json")
+        self.assertEqual(key, cache.key("select * from files where size > %(s)s", {"s": 0}, "json"))
+        self.assertNotEqual(key, cache.key("select * from files where size > %(s)s;", {"s": 0}, "json"))
+        self.assertNotEqual(key, cache.key("select * from files where size > %(s)s", {"s": 1}, "json"))
+        self.assertNotEqual(key, cache.key("select * from files where size > %(s)s", {"s": 0}, "compact_json"))
+        generation = get_data_generation()
+        self.assertEqual(bump_data_generation(), generation + 1)
+        self.assertEqual(get_data_generation(), generation + 1)
+        self.assertNotEqual(key, cache.key("select * from files where size > %(s)s", {"s": 0}, "json"))
+
+    def test_query_result_cache_shared_store(self):
+        with tempfile.TemporaryDirectory() as td, patch.object(config, "query_result_cache_url", td):
+            cache = QueryResultCache()
+            cache.put("k", b"result")
+            self.assertEqual(os.listdir(td), ["k"])
+            cache.clear()
+            self.assertEqual(cache.get("k"), b"result")
+            self.assertEqual(cache.local.get("k"), b"result")
+            self.assertIsNone(cache.get("other"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os, sys, io, json, gzip, datetime, unittest
+from collections import namedtuple
+from decimal import Decimal
+from unittest.mock import Mock
+
+import brotli
+import pyarrow as pa, pyarrow.parquet as pq
+
+from dcpquery.api.result_writers import (JSONResultWriter, CompactJSONResultWriter, NDJSONResultWriter,
+                                         CSVResultWriter, TSVResultWriter, ArrowResultWriter, ParquetResultWriter)
+from dcpquery.exceptions import QuerySizeError
+
+
+class TestJSONResultWriter(unittest.TestCase):
+    rows = [{"fqid": "a.1", "size": 1, "version": datetime.datetime(2019, 1, 1)},
+            {"fqid": "b.2", "size": 2, "version": datetime.datetime(2019, 1, 2)}]
+
+    def test_json_result_writer(self):
+        fh = io.BytesIO()
+        writer = JSONResultWriter(fh, header=dict(query="select 1", params={}))
+        writer.write_rows(self.rows)
+        writer.close()
+        doc = json.loads(fh.getvalue())
+        self.assertEqual(list(doc.keys()), ["query", "params", "results"])
+        self.assertEqual(doc["results"][1], {"fqid": "b.2", "size": 2, "version": "2019-01-02T00:00:00Z"})
+        self.assertEqual(writer.rows_written, 2)
+        self.assertEqual(writer.bytes_written, len(fh.getvalue()))
+
+    def test_json_result_writer_without_rows(self):
+        fh = io.BytesIO()
+        writer = JSONResultWriter(fh, results_key="result")
+        writer.close()
+        self.assertEqual(json.loads(fh.getvalue()), {"result": []})
+
+    def test_json_result_writer_compression(self):
+        for content_encoding, decompress in ("gzip", gzip.decompress), ("br", brotli.decompress):
+            fh = io.BytesIO()
+            writer = JSONResultWriter(fh, header=dict(query="select 1"), content_encoding=content_encoding)
+            writer.write_rows(self.rows)
+            writer.close()
+            self.assertEqual(len(json.loads(decompress(fh.getvalue()))["results"]), 2)
+            self.assertEqual(writer.bytes_written, len(decompress(fh.getvalue())))
+
+    def test_compact_json_result_writer(self):
+        fh = io.BytesIO()
+        writer = CompactJSONResultWriter(fh, header=dict(query="select 1"), cursor=Mock(keys=lambda: ["fqid", "size"]))
+        writer.write_rows([("a.1", 1), ("b.2", 2)])
+        writer.close()
+        self.assertEqual(json.loads(fh.getvalue()), {"query": "select 1", "columns": ["fqid", "size"],
+                                                     "results": [["a.1", 1], ["b.2", 2]]})
+
+    def test_json_result_writer_max_size(self):
+        writer = JSONResultWriter(io.BytesIO(), max_size=64)
+        with self.assertRaises(QuerySizeError):
+            writer.write_rows(self.rows * 10)
+        self.assertLess(writer.rows_written, 20)
+
+
+class TestLineDelimitedResultWriters(unittest.TestCase):
+    rows = [{"fqid": "a.1", "size": 1, "body": {"x": [1, "y"]}, "aux": None},
+            {"fqid": "b.2", "size": 2, "body": {}, "aux": datetime.datetime(2019, 1, 2)}]
+
+    def test_ndjson_result_writer(self):
+        fh = io.BytesIO()
+        writer = NDJSONResultWriter(fh, content_encoding="gzip")
+        writer.write_rows(self.rows)
+        writer.close()
+        lines = gzip.decompress(fh.getvalue()).decode().splitlines()
+        self.assertEqual([json.loads(line)["fqid"] for line in lines], ["a.1", "b.2"])
+        self.assertEqual(json.loads(lines[0])["body"], {"x": [1, "y"]})
+
+    def test_csv_result_writer(self):
+        fh = io.BytesIO()
+        writer = CSVResultWriter(fh)
+        writer.write_rows(self.rows)
+        writer.close()
+        self.assertEqual(fh.getvalue().decode().splitlines(), ['fqid,size,body,aux',
+                                                               'a.1,1,"{""x"": [1, ""y""]}",',
+                                                               'b.2,2,{},2019-01-02T00:00:00Z'])
+        self.assertEqual(writer.rows_written, 2)
+
+    def test_tsv_result_writer_without_rows(self):
+        fh = io.BytesIO()
+        writer = TSVResultWriter(fh, cursor=Mock(keys=lambda: ["fqid", "size"]))
+        writer.close()
+        self.assertEqual(fh.getvalue(), b"fqid\tsize\r\n")
+
+
+class TestColumnarResultWriters(unittest.TestCase):
+    Column = namedtuple("Column", "name type_code precision scale", defaults=(None, None))
+    cursor = Mock(description=[Column("fqid", 1043), Column("size", 20), Column("body", 3802), Column("version", 1114)])
+    rows = [("a.1", 1, {"x": [1, "y"]}, datetime.datetime(2019, 1, 1)),
+            ("b.2", None, None, datetime.datetime(2019, 1, 2))]
+
+    def test_arrow_result_writer(self):
+        fh = io.BytesIO()
+        writer = ArrowResultWriter(fh, cursor=self.cursor)
+        writer.write_rows(self.rows)
+        writer.write_rows(self.rows)
+        writer.close()
+        table = pa.ipc.open_stream(fh.getvalue()).read_all()
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(table.schema.types, [pa.string(), pa.int64(), pa.string(), pa.timestamp("us")])
+        self.assertEqual(table.to_pydict()["body"][:2], ['{"x": [1, "y"]}', None])
+        self.assertEqual(writer.rows_written, 4)
+
+    def test_arrow_result_writer_numeric_columns(self):
+        fh = io.BytesIO()
+        cursor = Mock(description=[self.Column("price", 1700, 10, 2), self.Column("ratio", 1700)])
+        writer = ArrowResultWriter(fh, cursor=cursor)
+        writer.write_rows([(Decimal("12345678.91"), Decimal("0.1000000000000000000001")), (None, None)])
+        writer.close()
+        table = pa.ipc.open_stream(fh.getvalue()).read_all()
+        self.assertEqual(table.schema.types, [pa.decimal128(10, 2), pa.string()])
+        self.assertEqual(table.to_pydict(), {"price": [Decimal("12345678.91"), None],
+                                             "ratio": ["0.1000000000000000000001", None]})
+
+    def test_arrow_result_writer_without_rows(self):
+        fh = io.BytesIO()
+        ArrowResultWriter(fh, cursor=self.cursor).close()
+        table = pa.ipc.open_stream(fh.getvalue()).read_all()
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema.names, ["fqid", "size", "body", "version"])
+
+    def test_parquet_result_writer(self):
+        fh = io.BytesIO()
+        writer = ParquetResultWriter(fh, cursor=self.cursor, content_encoding="br")
+        writer.row_group_size = 3
+        for i in range(3):
+            writer.write_rows(self.rows)
+        writer.close()
+        parquet_file = pq.ParquetFile(io.BytesIO(fh.getvalue()))
+        self.assertEqual(parquet_file.metadata.num_rows, 6)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        self.assertEqual(parquet_file.metadata.row_group(0).column(0).compression, "BROTLI")
+        self.assertEqual(parquet_file.read().to_pydict()["size"], [1, None] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os, sys, json, shutil, inspect, tempfile, unittest
+from unittest.mock import patch
+
+from connexion.apis.abstract import AbstractAPI
+
+from dcpquery import config
+from dcpquery.api import ChaliceWithConnexion
+from dcpquery.api.spec import (compile_spec, load_compiled_spec, get_compiled_spec_path, get_routes,
+                               CompiledSpecFlaskApi)
+
+swagger_spec_path = os.path.join(os.path.dirname(__file__), "..", "..", f"{os.environ['APP_NAME']}-api.yml")
+
+
+class TestCompiledSpec(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.swagger_spec_path = os.path.join(self.tempdir.name, os.path.basename(swagger_spec_path))
+        shutil.copy(swagger_spec_path, self.swagger_spec_path)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_compiled_spec(self):
+        self.assertIsNone(load_compiled_spec(self.swagger_spec_path))
+        eager_app = ChaliceWithConnexion(swagger_spec_path=self.swagger_spec_path, app_name=os.environ["APP_NAME"])
+        self.assertIsNotNone(eager_app._connexion_app)
+        compiled_spec = compile_spec(self.swagger_spec_path, os.environ["APP_NAME"])
+        with open(get_compiled_spec_path(self.swagger_spec_path), "w") as fh:
+            json.dump(compiled_spec, fh)
+        self.assertEqual(load_compiled_spec(self.swagger_spec_path)["routes"], compiled_spec["routes"])
+        with patch.object(config, "api_compiled_spec", False):
+            self.assertIsNone(load_compiled_spec(self.swagger_spec_path))
+
+        app = ChaliceWithConnexion(swagger_spec_path=self.swagger_spec_path, app_name=os.environ["APP_NAME"])
+        self.assertIsNone(app._connexion_app)
+        self.assertEqual(app.routes.keys(), eager_app.routes.keys())
+        for route in app.routes:
+            self.assertEqual(app.routes[route].keys(), eager_app.routes[route].keys())
+        self.assertEqual(app.trailing_slash_routes, eager_app.trailing_slash_routes)
+        with patch("connexion.spec.OpenAPISpecification._validate_spec") as validate_spec:
+            self.assertIsNotNone(app.fast_router.get("/v1/query", "POST"))
+        validate_spec.assert_not_called()
+        self.assertNotIn("$ref", json.dumps(compiled_spec["spec"]["resolved"]))
+        self.assertEqual(app.connexion_api.specification.raw, eager_app.connexion_api.specification.raw)
+        self.assertEqual(get_routes(app.connexion_app.app), get_routes(eager_app.connexion_app.app))
+        # CompiledSpecFlaskApi replicates the Connexion AbstractAPI constructor, which must set up the same state
+        self.assertEqual(inspect.signature(CompiledSpecFlaskApi.__init__), inspect.signature(AbstractAPI.__init__))
+        self.assertIsInstance(app.connexion_api, CompiledSpecFlaskApi)
+        self.assertEqual(vars(app.connexion_api).keys(), vars(eager_app.connexion_api).keys())
+        for attr, value in vars(eager_app.connexion_api).items():
+            self.assertIsInstance(getattr(app.connexion_api, attr), type(value), msg=attr)
+            if isinstance(value, (str, int, dict, list, type(None))):
+                self.assertEqual(getattr(app.connexion_api, attr), value, msg=attr)
+        self.assertEqual(app.connexion_api.options.as_dict(), eager_app.connexion_api.options.as_dict())
+
+        with open(self.swagger_spec_path, "a") as fh:
+            fh.write("\n")
+        self.assertIsNone(load_compiled_spec(self.swagger_spec_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os, sys, tempfile, unittest
+from unittest.mock import patch
+
+from dcpquery.api.uploads import S3MultipartUpload, LocalFileUpload
+
+
+@patch("dcpquery.api.uploads.clients")
+class TestS3MultipartUpload(unittest.TestCase):
+    def test_small_upload_uses_single_put(self, clients):
+        with S3MultipartUpload("bucket", "key", part_size=8, ContentType="application/json") as upload:
+            upload.write(b"abc")
+        clients.s3.put_object.assert_called_once_with(Bucket="bucket", Key="key", Body=b"abc",
+                                                      ContentType="application/json")
+        clients.s3.create_multipart_upload.assert_not_called()
+        self.assertEqual(upload.location, {"Bucket": "bucket", "Key": "key"})
+
+    def test_multipart_upload(self, clients):
+        clients.s3.create_multipart_upload.return_value = {"UploadId": "u"}
+        clients.s3.upload_part.side_effect = lambda **kwargs: {"ETag": "etag%d" % kwargs["PartNumber"]}
+        upload = S3MultipartUpload("bucket", "key", part_size=8)
+        for i in range(10):
+            upload.write(b"abc")
+        self.assertEqual(upload.close(), {"Bucket": "bucket", "Key": "key"})
+        self.assertEqual(upload.size, 30)
+        bodies = [c[1]["Body"] for c in clients.s3.upload_part.call_args_list]
+        self.assertEqual(bodies, [b"abcabcab", b"cabcabca", b"bcabcabc", b"abcabc"])
+        clients.s3.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="key", UploadId="u",
+            MultipartUpload={"Parts": [{"ETag": "etag%d" % i, "PartNumber": i} for i in range(1, 5)]}
+        )
+        clients.s3.put_object.assert_not_called()
+
+    def test_multipart_upload_aborted_on_error(self, clients):
+        clients.s3.create_multipart_upload.return_value = {"UploadId": "u"}
+        with self.assertRaises(RuntimeError):
+            with S3MultipartUpload("bucket", "key", part_size=2) as upload:
+                upload.write(b"abc")
+                raise RuntimeError()
+        clients.s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key="key", UploadId="u")
+        clients.s3.complete_multipart_upload.assert_not_called()
+
+
+class TestLocalFileUpload(unittest.TestCase):
+    def test_local_file_upload(self):
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "job_result", "1")
+            with LocalFileUpload(path) as upload:
+                upload.write(b"abc")
+                self.assertFalse(os.path.exists(path))
+            self.assertEqual(upload.location, {"Path": path})
+            with open(path, "rb") as fh:
+                self.assertEqual(fh.read(), b"abc")
+            with self.assertRaises(RuntimeError):
+                with LocalFileUpload(os.path.join(td, "job_result", "2")) as upload:
+                    upload.write(b"abc")
+                    raise RuntimeError()
+            self.assertEqual(os.listdir(os.path.join(td, "job_result")), ["1"])
+
+
+if __name__ == '__main__':
+    unittest.main()